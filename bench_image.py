@@ -0,0 +1,233 @@
+"""
+Benchmark for the image preparation path.
+
+Generates synthetic sources in several sizes and formats, then runs each
+function on each source in a fresh subprocess so peak RSS is per case.
+Reports median wall time, peak RSS and output bytes.
+
+    python bench_image.py
+    python bench_image.py --save-baseline bench_baseline.json
+    python bench_image.py --compare bench_baseline.json --tolerance 0.25
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+from pillow_heif import register_heif_opener
+
+register_heif_opener()
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS = ('resize_image', 'add_text_with_rounded_background', 'rotate_image', 'largest_rotated_rect',
+             'prepare_upload')
+FORMATS = {'jpeg': ('JPEG', '.jpg'), 'png': ('PNG', '.png'), 'heic': ('HEIF', '.heic')}
+DEFAULT_SIZES = ('1080x1350', '3024x4032', '6000x8000')
+LABEL = "Benchmark label 123"
+ROTATE_ANGLE = 7
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def make_source(folder, size, fmt):
+    """Gradient plus noise: compresses roughly like a photo instead of like flat colour or pure noise."""
+    width, height = size
+    pil_format, extension = FORMATS[fmt]
+    path = os.path.join(folder, f"source_{width}x{height}{extension}")
+    if os.path.exists(path):
+        return path
+    rng = np.random.default_rng(width * height)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.empty((height, width, 3), dtype=np.float32)
+    pixels[..., 0] = x
+    pixels[..., 1] = y
+    pixels[..., 2] = (x + y) / 2
+    pixels += rng.normal(0, 12, size=(height, width, 1))
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, pil_format)
+    return path
+
+
+def peak_rss_bytes():
+    """
+    Peak RSS of this process. VmHWM is reset by exec; ru_maxrss is not, and
+    would report the parent's peak from building the large sources.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # no procfs (macOS): ru_maxrss, in bytes there
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_case(function, source, work_folder, repeat):
+    """Runs inside the child process; prints one JSON line."""
+    import cv2
+    from image_lib import resize_image, rotate_image, largest_rotated_rect, prepare_upload
+    from image_text import add_text_with_rounded_background
+
+    import_rss = peak_rss_bytes()
+    extension = os.path.splitext(source)[1]
+    timings = []
+    output_bytes = None
+
+    for index in range(repeat):
+        work_path = os.path.join(work_folder, f"work_{index}{extension}")
+        shutil.copyfile(source, work_path)
+
+        if function == 'resize_image':
+            started = time.perf_counter()
+            resize_image(work_path)
+            timings.append(time.perf_counter() - started)
+            output_bytes = os.path.getsize(work_path)
+
+        elif function == 'add_text_with_rounded_background':
+            started = time.perf_counter()
+            add_text_with_rounded_background(LABEL, work_path)
+            timings.append(time.perf_counter() - started)
+            output_bytes = os.path.getsize(work_path)
+
+        elif function == 'rotate_image':
+            image = cv2.cvtColor(np.asarray(Image.open(work_path).convert("RGB")), cv2.COLOR_RGB2BGR)
+            started = time.perf_counter()
+            rotated = rotate_image(image, ROTATE_ANGLE)
+            timings.append(time.perf_counter() - started)
+            output_bytes = rotated.nbytes
+
+        elif function == 'largest_rotated_rect':
+            width, height = Image.open(work_path).size
+            started = time.perf_counter()
+            for _ in range(10000):
+                largest_rotated_rect(width, height, np.radians(ROTATE_ANGLE))
+            timings.append((time.perf_counter() - started) / 10000)
+            output_bytes = 0
+
+        elif function == 'prepare_upload':
+            output_path = os.path.join(work_folder, f"out_{index}.jpg")
+            started = time.perf_counter()
+            prepare_upload(work_path, output_path, LABEL)
+            timings.append(time.perf_counter() - started)
+            output_bytes = os.path.getsize(output_path)
+
+        else:
+            raise ValueError(f"Unknown function {function}")
+
+    print(json.dumps({
+        'wall_s': statistics.median(timings),
+        'min_wall_s': min(timings),
+        'peak_rss_mb': round(peak_rss_bytes() / 1024 ** 2, 1),
+        'import_rss_mb': round(import_rss / 1024 ** 2, 1),
+        'output_bytes': output_bytes,
+    }))
+
+
+def run_in_subprocess(function, source, repeat):
+    with tempfile.TemporaryDirectory() as work_folder:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-case', function, source, work_folder, str(repeat)],
+            cwd=HERE, capture_output=True, text=True,
+        )
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed'}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_suite(functions, formats, sizes, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as source_folder:
+        for fmt in formats:
+            for size in sizes:
+                fmt_folder = os.path.join(source_folder, fmt)
+                os.makedirs(fmt_folder, exist_ok=True)
+                source = make_source(fmt_folder, parse_size(size), fmt)
+                for function in functions:
+                    key = f"{function}/{fmt}/{size}"
+                    results[key] = run_in_subprocess(function, source, repeat)
+                    print_row(key, results[key])
+    return results
+
+
+def print_row(key, result, baseline=None):
+    if 'error' in result:
+        print(f"{key:<52} ERROR {result['error']}")
+        return
+    row = (f"{key:<52} {result['wall_s'] * 1000:>10.3f} ms {result['peak_rss_mb']:>8.1f} MB "
+           f"{result['output_bytes']:>12} B")
+    if baseline and 'wall_s' in baseline:
+        row += f"  ({result['wall_s'] / baseline['wall_s'] - 1:+.0%} time, "
+        row += f"{result['peak_rss_mb'] - baseline['peak_rss_mb']:+.1f} MB)"
+    print(row)
+
+
+def compare(results, baseline, tolerance):
+    """Returns the cases whose time or peak RSS grew by more than tolerance."""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base or 'wall_s' not in base or 'wall_s' not in result:
+            continue
+        if result['wall_s'] > base['wall_s'] * (1 + tolerance):
+            regressions.append(f"{key}: wall {base['wall_s'] * 1000:.2f} -> {result['wall_s'] * 1000:.2f} ms")
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{key}: peak RSS {base['peak_rss_mb']} -> {result['peak_rss_mb']} MB")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the image preparation path")
+    arg_parser.add_argument("--functions", default=','.join(FUNCTIONS))
+    arg_parser.add_argument("--formats", default=','.join(FORMATS))
+    arg_parser.add_argument("--sizes", default=','.join(DEFAULT_SIZES))
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--save-baseline", metavar="PATH")
+    arg_parser.add_argument("--compare", metavar="PATH")
+    arg_parser.add_argument("--tolerance", type=float, default=0.25)
+    arg_parser.add_argument("--run-case", nargs=4, metavar=("FUNCTION", "SOURCE", "WORK_FOLDER", "REPEAT"),
+                            help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.run_case:
+        function, source, work_folder, repeat = args.run_case
+        run_case(function, source, work_folder, int(repeat))
+        return 0
+
+    print(f"{'case':<52} {'median':>13} {'peak RSS':>11} {'output':>14}")
+    results = run_suite(args.functions.split(','), args.formats.split(','), args.sizes.split(','), args.repeat)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nAgainst {args.compare}:")
+        for key, result in results.items():
+            print_row(key, result, baseline.get(key))
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.tolerance:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,129 @@
 import configparser
 import logging
+import os
+import threading
+import time
 
-CONFIG = None
-ACCOUNTS = None
+CONFIG_PATH = os.environ.get('CONFIG_PATH', 'config.txt')
+ADS_ACCOUNTS_PATH = os.environ.get('ADS_ACCOUNTS_PATH', 'config_ads_account.txt')
+RELOAD_CHECK_INTERVAL = 5
+
+
+class AdsAccount:
+    def __init__(self, name, ads_id, username, password, close):
+        self.name = name
+        self.ads_id = ads_id
+        self.username = username
+        self.password = password
+        self.close = close
+
+
+class ConfigRegistry:
+    """
+    Parsed config.txt and config_ads_account.txt, with accounts indexed by
+    name and by ads_id. Lookups re-check the files' mtimes at most every
+    check_interval seconds and reload whichever file changed. A reload that
+    fails keeps the previous values.
+    """
+
+    def __init__(self, config_path=CONFIG_PATH, accounts_path=ADS_ACCOUNTS_PATH, check_interval=RELOAD_CHECK_INTERVAL):
+        self.config_path = config_path
+        self.accounts_path = accounts_path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.checked_at = None
+        self.mtimes = {}
+        self.config = None
+        self.sections = {}
+        self.accounts_by_name = {}
+        self.accounts_by_ads_id = {}
+
+    @staticmethod
+    def mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return
+        with self.lock:
+            if not force and self.checked_at is not None and now - self.checked_at < self.check_interval:
+                return
+            self.checked_at = now
+
+            config_mtime = self.mtime(self.config_path)
+            if self.config is None or config_mtime != self.mtimes.get(self.config_path):
+                self.load_config()
+                self.mtimes[self.config_path] = config_mtime
+
+            accounts_mtime = self.mtime(self.accounts_path)
+            if accounts_mtime != self.mtimes.get(self.accounts_path, -1):
+                self.load_accounts()
+                self.mtimes[self.accounts_path] = accounts_mtime
+
+    def load_config(self):
+        config = configparser.ConfigParser()
+        try:
+            with open(self.config_path, 'r', encoding='utf-8') as configfile:
+                config.read_file(configfile)
+        except Exception as e:
+            if self.config is None:
+                raise
+            logging.error(f"Error reloading {self.config_path}, keeping previous config: {e}")
+            return
+        self.config = config
+        self.sections = {section: dict(config.items(section)) for section in config.sections()}
+        logging.info(f"Loaded {self.config_path}")
+
+    def load_accounts(self):
+        config = configparser.ConfigParser()
+        by_name = {}
+        by_ads_id = {}
+        try:
+            if not config.read(self.accounts_path, encoding='utf-8'):
+                raise FileNotFoundError(self.accounts_path)
+            for section in config.sections():
+                account = AdsAccount(
+                    section,
+                    config.get(section, 'profile_serial_number', fallback=None),
+                    config.get(section, 'username', fallback=None),
+                    config.get(section, 'password', fallback=None),
+                    config.getboolean(section, 'close', fallback=False),
+                )
+                by_name[section] = account
+                if account.ads_id:
+                    by_ads_id[account.ads_id] = account
+        except Exception as e:
+            logging.error(f"Error reading {self.accounts_path}, keeping previous accounts: {e}")
+            return
+        self.accounts_by_name = by_name
+        self.accounts_by_ads_id = by_ads_id
+        logging.info(f"Loaded {len(by_name)} accounts from {self.accounts_path}")
+
+    def general(self):
+        self.refresh()
+        return self.config['DEFAULT']
+
+    def get(self, key, default=None):
+        return self.general().get(key, default)
+
+    def account(self, name):
+        self.refresh()
+        return self.accounts_by_name.get(name)
+
+    def account_by_ads_id(self, ads_id):
+        self.refresh()
+        return self.accounts_by_ads_id.get(ads_id)
+
+
+registry = ConfigRegistry()
 
 
 def get_config():
-    global CONFIG
-    global ACCOUNTS
-    if CONFIG is None or ACCOUNTS is None:
-        CONFIG = configparser.ConfigParser()
-        with open('config.txt', 'r', encoding='utf-8') as configfile:
-            CONFIG.read_file(configfile)
-        ACCOUNTS = {section: dict(CONFIG.items(section)) for section in CONFIG.sections() if section != 'DEFAULT'}
-    return CONFIG['DEFAULT'], ACCOUNTS
+    return registry.general(), registry.sections
 
 
 def load_ads_accounts_config(file_path):
@@ -1,17 +1,151 @@
-import json
 import os
+import random
+import threading
 import time
 import requests
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from config_service import get_config
 from logger import log_interface
+from metrics import timed
 
+
+class AdsResponse:
+    def __init__(self, code, msg='', data=None):
+        self.code = code
+        self.msg = msg
+        self.data = data or {}
+
+    @property
+    def ok(self):
+        return self.code == 0
+
+    def __repr__(self):
+        return f"AdsResponse(code={self.code}, msg={self.msg!r}, data={self.data})"
+
+
+class BrowserStartResult(AdsResponse):
+    @property
+    def debugger_address(self):
+        return (self.data.get("ws") or {}).get("selenium")
+
+    @property
+    def webdriver_path(self):
+        return self.data.get("webdriver")
+
+
+class AdsPowerClient:
+    """
+    Thin client for the AdsPower local API. Keeps one pooled requests
+    Session, applies connect/read timeouts to every call and retries
+    connection errors, timeouts and rate-limit replies with exponential
+    backoff. Failures come back as responses with code -1.
+    """
+
+    def __init__(self, base_url, connect_timeout=3, read_timeout=60, retries=3, backoff=1.0, pool_size=10):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, params=None, body=None, result_class=AdsResponse, retries=None, timeout=None):
+        url = f"{self.base_url}{path}"
+        retries = self.retries if retries is None else retries
+        timeout = timeout or self.timeout
+        error = None
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1) + random.uniform(0, 0.5))
+            try:
+                resp = self.session.request(method, url, params=params, json=body, timeout=timeout)
+                if resp.status_code >= 500:
+                    error = f"HTTP {resp.status_code}"
+                    continue
+                resp.raise_for_status()
+                payload = resp.json()
+            except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+                error = str(e)
+                continue
+            except requests.RequestException as e:
+                return result_class(-1, str(e))
+
+            result = result_class(payload.get("code", -1), payload.get("msg", ""), payload.get("data"))
+            if not result.ok and "too many request" in str(result.msg).lower():
+                error = result.msg
+                continue
+            return result
+
+        log_interface(f"AdsPower request {path} failed after {retries + 1} attempts: {error}", "error")
+        return result_class(-1, str(error))
+
+    def start_browser(self, ads_id, open_tabs=0, ip_tab=0):
+        params = {"user_id": ads_id, "open_tabs": open_tabs, "ip_tab": ip_tab}
+        return self.request("GET", "/api/v1/browser/start", params=params, result_class=BrowserStartResult)
+
+    def stop_browser(self, ads_id):
+        return self.request("GET", "/api/v1/browser/stop", params={"user_id": ads_id})
+
+    def update_user(self, ads_id, body):
+        return self.request("POST", "/api/v1/user/update", params={"user_id": ads_id}, body=body)
+
+    def browser_status(self, ads_id, retries=None, timeout=None):
+        return self.request("GET", "/api/v1/browser/active", params={"user_id": ads_id},
+                            retries=retries, timeout=timeout)
+
+    def wait_until_released(self, ads_id, interval=0.5, deadline=15):
+        """
+        Polls the active-status endpoint until the profile reports Inactive.
+        Each poll is a single attempt whose timeout is capped at the time
+        left, so a hung AdsPower cannot hold the caller past the deadline.
+        """
+        stop_at = time.monotonic() + deadline
+        while True:
+            remaining = max(stop_at - time.monotonic(), 0.1)
+            timeout = (min(self.timeout[0], remaining), min(self.timeout[1], remaining))
+            status = self.browser_status(ads_id, retries=0, timeout=timeout)
+            if status.ok and status.data.get("status") != "Active":
+                return True
+            if time.monotonic() + interval > stop_at:
+                return False
+            time.sleep(interval)
+
+
+ADS_CLIENT = None
+ADS_CLIENT_LOCK = threading.Lock()
+WEBDRIVER_FACTORY = None
+
+
+def set_webdriver_factory(factory):
+    """Replaces webdriver.Chrome in get_driver, e.g. with fakes.StubWebDriver.factory()."""
+    global WEBDRIVER_FACTORY
+    WEBDRIVER_FACTORY = factory
+
+
+def get_ads_client():
+    global ADS_CLIENT
+    with ADS_CLIENT_LOCK:
+        if ADS_CLIENT is None:
+            config, accounts = get_config()
+            base_url = config.get('ADS_API_URL') or f"http://local.adspower.net:{config.get('ADS_PORT')}"
+            ADS_CLIENT = AdsPowerClient(
+                base_url,
+                connect_timeout=float(config.get('ADS_CONNECT_TIMEOUT', 3)),
+                read_timeout=float(config.get('ADS_READ_TIMEOUT', 60)),
+                retries=int(config.get('ADS_RETRIES', 3)),
+            )
+        return ADS_CLIENT
+
+
+@timed('get_driver', falsy_is_failure=True)
 def get_driver(ads_id, proxy=None, clean_cookies=False):
 
-    config, accounts = get_config()
-    print(config)
+    client = get_ads_client()
     if proxy is not None:
         json_proxy = {
             "proxy_soft": "other",
@@ -21,35 +155,29 @@ def get_driver(ads_id, proxy=None, clean_cookies=False):
             "proxy_user": proxy.split("@")[0].split(":")[0],
             "proxy_password": proxy.split("@")[0].split(":")[1]
         }
-        headers = {
-            "content-type": "application/json",
-        }
         body = {
             "user_id": ads_id,
             "user_proxy_config": json_proxy,
             "cookie": []
         }
-        print("Changing proxy settings", requests.post(
-            f"http://local.adspower.net:{config.get('ADS_PORT')}/api/v1/user/update?user_id={ads_id}",
-            data=json.dumps(body), headers=headers).text)
-    open_url = f"http://local.adspower.net:{config.get('ADS_PORT')}/api/v1/browser/start?user_id=" + ads_id + "&open_tabs=0&ip_tab=0"
-    resp = requests.get(open_url).json()
+        log_interface(f"Changing proxy settings for {ads_id}: {client.update_user(ads_id, body)}", "info")
+    resp = client.start_browser(ads_id)
     log_interface(f"ADS RESPONSE: {resp}", "info")
 
-    if resp["code"] != 0:
+    if not resp.ok:
         log_interface(f"Failed to start session in ADS BROWSER with id: {ads_id}", "error")
         return None
 
-    if "data" not in resp or "webdriver" not in resp["data"] or "ws" not in resp["data"] or "selenium" not in resp["data"]["ws"]:
+    if not resp.webdriver_path or not resp.debugger_address:
         log_interface(f"Invalid response structure: {resp}", "error")
         return None
 
-    debugger_address = resp["data"]["ws"]["selenium"]
-    if not debugger_address or ":" not in debugger_address:
+    debugger_address = resp.debugger_address
+    if ":" not in debugger_address:
         log_interface(f"Invalid debugger address for {ads_id}: {debugger_address}", "error")
         return None
 
-    chrome_driver = resp["data"]["webdriver"]
+    chrome_driver = resp.webdriver_path
     chrome_options = Options()
     chrome_options.add_experimental_option("debuggerAddress", debugger_address)
     chrome_options.add_argument("--disable-extensions")
@@ -58,7 +186,8 @@ def get_driver(ads_id, proxy=None, clean_cookies=False):
     log_interface(f"Starting Chrome driver for AdsPower ID: {ads_id}", "info")
 
     try:
-        driver = webdriver.Chrome(options=chrome_options, service=chrome_service)
+        factory = WEBDRIVER_FACTORY or webdriver.Chrome
+        driver = factory(options=chrome_options, service=chrome_service)
         log_interface(f"[ADS] [{ads_id}] - Browser started!", "success")
         if clean_cookies:
             driver.delete_all_cookies()
@@ -70,14 +199,21 @@ def get_driver(ads_id, proxy=None, clean_cookies=False):
         return None
 
 
+@timed('close_driver', falsy_is_failure=True)
 def close_driver(ads_id):
-
-    config, accounts = get_config()
-    close_url = f"http://local.adspower.net:{config['ADS_PORT']}/api/v1/browser/stop?user_id=" + ads_id
-    close_resp = requests.get(close_url).json()
+    """Stops the profile's browser; returns True once AdsPower reports it released."""
+    close_resp = get_ads_client().stop_browser(ads_id)
     log_interface(f"Close session response for {ads_id}: {close_resp}", "info")
 
-    if close_resp['code'] != -1:
+    if close_resp.code != -1:
         log_interface(f"[ADS] [{ads_id}] - Closing browser!", "warn")
-        time.sleep(10)
-
+        config, accounts = get_config()
+        released = get_ads_client().wait_until_released(
+            ads_id,
+            interval=float(config.get('ADS_RELEASE_POLL_INTERVAL', 0.5)),
+            deadline=float(config.get('ADS_RELEASE_TIMEOUT', 15)),
+        )
+        if not released:
+            log_interface(f"[ADS] [{ads_id}] - Browser still active after stop request", "warn")
+        return released
+    return False
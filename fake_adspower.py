@@ -0,0 +1,102 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeAdsPowerState:
+    def __init__(self, latency=0.0, failure_rate=0.0, debugger_address="127.0.0.1:9222",
+                 webdriver_path="/usr/bin/chromedriver"):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.debugger_address = debugger_address
+        self.webdriver_path = webdriver_path
+        self.lock = threading.Lock()
+        self.active = set()
+        self.calls = []
+
+    def handle(self, path, params):
+        user_id = params.get("user_id", [""])[0]
+        with self.lock:
+            self.calls.append((path, user_id))
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            return {"code": -1, "msg": "fake failure"}
+
+        if path == "/api/v1/browser/start":
+            with self.lock:
+                self.active.add(user_id)
+            return {"code": 0, "msg": "success", "data": {
+                "ws": {"selenium": self.debugger_address},
+                "webdriver": self.webdriver_path,
+            }}
+        if path == "/api/v1/browser/stop":
+            with self.lock:
+                self.active.discard(user_id)
+            return {"code": 0, "msg": "success"}
+        if path == "/api/v1/browser/active":
+            with self.lock:
+                status = "Active" if user_id in self.active else "Inactive"
+            return {"code": 0, "msg": "success", "data": {"status": status}}
+        if path == "/api/v1/user/update":
+            return {"code": 0, "msg": "success"}
+        return None
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self):
+            url = urlparse(self.path)
+            payload = state.handle(url.path, parse_qs(url.query))
+            if payload is None:
+                self.send_error(404)
+                return
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.reply()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            self.rfile.read(length)
+            self.reply()
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_fake_adspower(port=0, **kwargs):
+    """
+    Starts a fake AdsPower local API on 127.0.0.1 in a daemon thread.
+    Returns (server, state); the base url is http://127.0.0.1:{server.server_port}.
+    """
+    state = FakeAdsPowerState(**kwargs)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Fake AdsPower local API")
+    arg_parser.add_argument("--port", type=int, default=50325)
+    arg_parser.add_argument("--latency", type=float, default=0.0)
+    arg_parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = arg_parser.parse_args()
+    server, state = start_fake_adspower(args.port, latency=args.latency, failure_rate=args.failure_rate)
+    print(f"Fake AdsPower listening on http://127.0.0.1:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,234 @@
+"""
+In-process stand-ins for Airtable and the AdsPower browser, for running the
+poster offline (BACKEND = fake in config.txt) and for loadtest.py. The
+AdsPower local API itself is faked over HTTP by fake_adspower.py.
+"""
+import copy
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.remote.webelement import WebElement
+
+
+class FakeBackendError(Exception):
+    pass
+
+
+class FakeTable:
+    """
+    Airtable table kept in memory. Understands the two formulas main.py
+    sends: {Field} (truthy field) and IS_AFTER({Field}, DATETIME_PARSE('...')).
+    Every call sleeps latency seconds and fails with failure_rate.
+    """
+
+    def __init__(self, records=None, latency=0.0, failure_rate=0.0, modified_field='Last Modified', seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.modified_field = modified_field
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.records = {}
+        self.calls = {}
+        for fields in records or []:
+            self.insert(fields)
+
+    @classmethod
+    def from_json(cls, path, **kwargs):
+        """Loads a list of field dicts, or of {'fields': {...}} records, from path."""
+        with open(path, encoding='utf-8') as f:
+            rows = json.load(f)
+        return cls([row.get('fields', row) for row in rows], **kwargs)
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise FakeBackendError(f"fake {name} failure")
+
+    def now(self):
+        return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    def insert(self, fields):
+        record_id = f"rec{next(self.ids):014d}"
+        fields = {**fields, self.modified_field: self.now()}
+        with self.lock:
+            self.records[record_id] = {'id': record_id, 'createdTime': self.now(), 'fields': fields}
+        return copy.deepcopy(self.records[record_id])
+
+    def matches(self, record, formula):
+        if not formula:
+            return True
+        fields = record['fields']
+        after = re.fullmatch(r"IS_AFTER\(\{(.+)\}, DATETIME_PARSE\('(.+)'\)\)", formula)
+        if after:
+            value = fields.get(after.group(1))
+            return bool(value) and value > after.group(2)
+        truthy = re.fullmatch(r"\{(.+)\}", formula)
+        if truthy:
+            return bool(fields.get(truthy.group(1)))
+        raise FakeBackendError(f"Unsupported formula: {formula}")
+
+    def all(self, formula=None, **kwargs):
+        self.call('all')
+        with self.lock:
+            return [copy.deepcopy(record) for record in self.records.values() if self.matches(record, formula)]
+
+    def get(self, record_id):
+        self.call('get')
+        with self.lock:
+            return copy.deepcopy(self.records[record_id])
+
+    def create(self, fields, **kwargs):
+        self.call('create')
+        return self.insert(fields)
+
+    def apply(self, record_id, fields):
+        record = self.records.get(record_id)
+        if record is None:
+            raise FakeBackendError(f"Unknown record {record_id}")
+        record['fields'].update(fields)
+        record['fields'][self.modified_field] = self.now()
+        return copy.deepcopy(record)
+
+    def update(self, record_id, fields, **kwargs):
+        self.call('update')
+        with self.lock:
+            return self.apply(record_id, fields)
+
+    def batch_update(self, records, **kwargs):
+        self.call('batch_update')
+        if len(records) > 10:
+            raise FakeBackendError(f"batch_update takes at most 10 records, got {len(records)}")
+        with self.lock:
+            return [self.apply(record['id'], record['fields']) for record in records]
+
+
+class StubElement(WebElement):
+    """WebElement that accepts every action. Links report a fake post permalink."""
+
+    def __init__(self, driver, element_id):
+        super().__init__(driver, element_id)
+
+    def click(self):
+        self.parent.command()
+
+    def clear(self):
+        self.parent.command()
+
+    def send_keys(self, *value):
+        self.parent.command()
+
+    def is_displayed(self):
+        return True
+
+    def is_enabled(self):
+        return True
+
+    def is_selected(self):
+        return False
+
+    def get_attribute(self, name):
+        if name == 'href':
+            return f"https://www.reddit.com/r/test/comments/{self.id}/stub_post/"
+        return None
+
+    @property
+    def text(self):
+        return ''
+
+
+class StubWebDriver:
+    """
+    Stands in for webdriver.Chrome. Every command sleeps latency seconds;
+    each page load fails with failure_rate. Element lookups and scripts
+    always succeed, so the posting flow runs through to the permalink.
+    """
+
+    def __init__(self, options=None, service=None, latency=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.element_ids = itertools.count(1)
+        self.current_url = 'about:blank'
+        self.window_handles = ['main']
+        self.commands = 0
+        self.closed = False
+        self.switch_to = self
+
+    @classmethod
+    def factory(cls, latency=0.0, failure_rate=0.0):
+        """Returns a callable with webdriver.Chrome's signature, for driver.set_webdriver_factory."""
+        def make(options=None, service=None):
+            return cls(options, service, latency=latency, failure_rate=failure_rate)
+        return make
+
+    def command(self):
+        if self.closed:
+            raise WebDriverException("stub browser was closed")
+        self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def element(self):
+        return StubElement(self, f"stub{next(self.element_ids)}")
+
+    def get(self, url):
+        self.command()
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise WebDriverException(f"stub page load failed: {url}")
+        self.current_url = url
+
+    def find_element(self, by=None, value=None):
+        self.command()
+        return self.element()
+
+    def find_elements(self, by=None, value=None):
+        self.command()
+        return [self.element()]
+
+    def execute_script(self, script, *args):
+        self.command()
+        if 'scrollHeight' in script or 'scrollWidth' in script:
+            return 1000
+        return True
+
+    def execute_async_script(self, script, *args):
+        self.command()
+        paths = args[0] if args else None
+        if isinstance(paths, dict) and paths:
+            return [next(iter(paths)), self.element()]
+        return True
+
+    def execute_cdp_cmd(self, cmd, params):
+        self.command()
+        if cmd == 'Page.getLayoutMetrics':
+            return {'cssContentSize': {'width': 1280, 'height': 1000}}
+        return {'data': ''}
+
+    def set_script_timeout(self, timeout):
+        pass
+
+    def get_screenshot_as_base64(self):
+        self.command()
+        return ''
+
+    def delete_all_cookies(self):
+        self.command()
+
+    def window(self, handle):
+        self.command()
+
+    def close(self):
+        self.command()
+
+    def quit(self):
+        self.closed = True
@@ -2,6 +2,7 @@ import io
 import math
 import os
 import random
+import uuid
 from datetime import datetime
 import cv2
 import numpy as np
@@ -13,6 +14,11 @@ from dateutil.relativedelta import relativedelta
 from pillow_heif import register_heif_opener
 
 from cv2 import imread, imwrite
+from image_text import composite_label
+
+register_heif_opener()
+
+PREPARED_FOLDER = 'temp/prepared'
 
 
 # Function to generate a random name in the range [1000, 1500]
@@ -261,9 +267,10 @@ def get_new_exif(width, height, pil_image=None):
 def modify_exif_shooted_older(file_path, points):
     try:
         img = Image.open(file_path)
-        img.save(file_path,
-                 exif=piexif.dump(
-                     get_new_exif(width=img.width, height=img.height, pil_image=img)))
+        exif_bytes = piexif.dump(get_new_exif(width=img.width, height=img.height, pil_image=img))
+        img.close()
+        # swap the EXIF segment only; re-saving would re-encode the pixels at PIL's default quality
+        piexif.insert(exif_bytes, file_path)
     except Exception as e:
         print("modify_exif_shooted_older error ", e)
 
@@ -272,14 +279,15 @@ def making_decision(percent):
     return random.randrange(100) < int(percent)
 
 
-def noise(in_path):
+def noise(in_path, quality=None):
     # Random noise
     try:
         img = imread(in_path)
         noise = np.random.normal(0, random.uniform(1, 3), img.shape)
         img_noised = img + noise
         img_noised = np.clip(img_noised, 0, 255).astype(np.uint8)
-        imwrite(in_path, img_noised)
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)] if quality is not None else []
+        imwrite(in_path, img_noised, params)
     except Exception:
         print("ERROR noise")
 
@@ -338,9 +346,11 @@ def apply_random_transformations(image):
         return None
 
 
-def resize_image(input_image):
-    new_width, new_height = 3024, 4032
-    image = Image.open(input_image)
+UPLOAD_SIZE = (3024, 4032)
+
+
+def crop_and_resize(image, size=UPLOAD_SIZE):
+    new_width, new_height = size
     width, height = image.size
     aspect_ratio = width / height
     target_aspect_ratio = new_width / new_height
@@ -357,21 +367,84 @@ def resize_image(input_image):
         right = width
         bottom = (height + crop_height) / 2
     image = image.crop((left, top, right, bottom))
-    image = image.resize((new_width, new_height))
+    return image.resize((new_width, new_height))
+
+
+def resize_image(input_image):
+    image = Image.open(input_image)
+    image = crop_and_resize(image)
     image.save(input_image)
 
 
-def process_image(input_image_path, make_photo_now=False, points=None):
+def open_for_size(source, size=UPLOAD_SIZE, margin=1.0):
+    """
+    Opens an image decoded at roughly the smallest size that still covers
+    size * margin. JPEGs use draft mode so libjpeg scales while decoding;
+    other formats (HEIC, PNG) are box-reduced right after decoding.
+    """
+    image = Image.open(source)
+    width, height = image.size
+    scale = max(size[0] / width, size[1] / height) * margin
+    if scale >= 0.5:
+        return image
+    if image.format == "JPEG":
+        image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+        return image
+    exif = image.info.get("exif") or b""
+    image = image.reduce(int(1 / scale))
+    image.info["exif"] = exif
+    return image
+
+
+def normalize_source(image_path, size=UPLOAD_SIZE, margin=1.5):
+    """
+    Rewrites oversized or non-JPEG/PNG sources (e.g. HEIC) in place as a
+    JPEG close to the upload size, so the rest of the pipeline decodes a
+    small file that OpenCV can read.
+    """
+    with Image.open(image_path) as header:
+        original_size = header.size
+    image = open_for_size(image_path, size, margin)
+    if image.format in ("JPEG", "PNG") and image.size == original_size:
+        return image_path
+    exif = image.info.get("exif") or b""
+    image.convert("RGB").save(image_path, "JPEG", quality=95, exif=exif)
+    return image_path
+
+
+def prepare_upload(source, output_path, text_overlay=None, quality=90):
+    """
+    Crops, resizes and optionally labels an image in one pass. source may be
+    the downloaded bytes or a path; the image is decoded once and written
+    to output_path once, as JPEG.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    image = open_for_size(source)
+    exif = image.info.get("exif") or b""
+    image = crop_and_resize(image.convert("RGB"))
+    if text_overlay is not None:
+        composite_label(image, text_overlay)
+    image.save(output_path, "JPEG", quality=quality, exif=exif)
+    return output_path
+
+
+def process_image(input_image_path, make_photo_now=False, points=None, text_overlay=None, quality=90):
     print("Processing image!")
     if points is None:
         points = {}
     try:
         old_name = os.path.basename(input_image_path)
+        normalize_source(input_image_path)
         noise(input_image_path)
         img = Image.open(input_image_path).convert("RGB")
         img = apply_random_transformations(img)
         new_name = generate_random_name()
-        new_file_path = f"temp/{new_name}.jpeg"
+        # the camera-style name has only ~8000 values and prefetched files wait on disk
+        # for their post time, so each job gets its own folder
+        job_folder = os.path.join(PREPARED_FOLDER, uuid.uuid4().hex)
+        os.makedirs(job_folder)
+        new_file_path = os.path.join(job_folder, f"{new_name}.jpeg")
         img.save(new_file_path)
         input_image_path = os.path.abspath(new_file_path)
         image = cv2.imread(input_image_path)
@@ -392,8 +465,9 @@ def process_image(input_image_path, make_photo_now=False, points=None):
         #     if make_photo_now:
         #         modify_exif_shooted(f"{new_path}/{new_name}.jpg")
         #     else:
-        resize_image(input_image_path)
-        noise(input_image_path)
+        prepare_upload(input_image_path, input_image_path, text_overlay, quality)
+        # last pixel write of the pipeline, so it is the one that sets the upload's JPEG quality
+        noise(input_image_path, quality)
         change_metadata(input_image_path, new_name)
         modify_exif_shooted_older(input_image_path, points)
         change_md5(input_image_path)
@@ -430,6 +504,11 @@ def input_image_path(image_path):
     result = process_image(image_path)
     return result
 
+
+def prepare_image(image_path, text_overlay=None, quality=90):
+    """Full upload preparation for one image; runs inside the image process pool."""
+    return process_image(image_path, text_overlay=text_overlay, quality=quality)
+
 # if __name__ == "__main__":
 #     # Змініть шлях до зображення на звичайний шлях
 #     input_image_path = "/Users/oksana/Downloads/IMG_1035.jpg"
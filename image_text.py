@@ -1,9 +1,13 @@
 import os.path
 import random
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont
 import logging
 import numpy as np
 
+FONT_PATH = "SFPRODISPLAYMEDIUM.OTF"
+JPEG_QUALITY = 90
+
 
 def calculate_luminance(rgb_color):
     r, g, b = rgb_color[:3]
@@ -18,57 +22,107 @@ def get_text_color(background_color):
         return (255, 255, 255)
 
 
-def add_text_with_rounded_background(text, image_path, font_size=200):
-    try:
-        if not os.path.exists(image_path):
-            logging.error(f"Файл зображення не знайдено: {image_path}")
-            return None
+@lru_cache(maxsize=32)
+def load_font(font_path, font_size):
+    return ImageFont.truetype(font_path, font_size)
 
-        font_path = "SFPRODISPLAYMEDIUM.OTF"
 
-        if not os.path.exists(font_path):
-            logging.error(f"Файл шрифту не знайдено за шляхом: {font_path}")
-            return None
+@lru_cache(maxsize=64)
+def render_label_masks(text, font_size):
+    """
+    Renders the alpha masks of a label's rounded background and text. They
+    do not depend on the colours, so they are cached per text and size.
+    Callers must not modify the returned images.
+    """
+    font = load_font(FONT_PATH, font_size)
+    text_bbox = font.getbbox(text)
+
+    padding = font_size // 2
+    box_width = text_bbox[2] - text_bbox[0] + padding * 2
+    box_height = text_bbox[3] - text_bbox[1] + padding * 2
+
+    background = Image.new("L", (box_width, box_height), 0)
+    bg_draw = ImageDraw.Draw(background)
+
+    bg_draw.rounded_rectangle([0, 0, box_width, box_height], radius=20, fill=255)
+
+    text_mask = Image.new("L", (box_width, box_height), 0)
+    text_draw = ImageDraw.Draw(text_mask)
 
-        image = Image.open(image_path).convert("RGBA")
-        (width, height) = image.size
+    text_draw.text((padding, padding), text, font=font, fill=255)
+    return background, text_mask
 
-        text_position = (int(width / 2), int(height * 0.75))
 
-        pixel_color = image.getpixel((int(width / 2), int(height / 2)))
+@lru_cache(maxsize=512)
+def rotated_label_mask(text, font_size, layer, angle):
+    """layer 0 is the background, 1 the text; angles are whole degrees, so there are few variants."""
+    return render_label_masks(text, font_size)[layer].rotate(angle, expand=1)
 
-        font = ImageFont.truetype(font_path, font_size)
 
-        text_color = get_text_color(pixel_color)
+def colorize(mask, color):
+    tile = Image.new("RGBA", mask.size, tuple(color[:3]))
+    tile.putalpha(mask)
+    return tile
 
-        draw = ImageDraw.Draw(image)
 
-        text_bbox = draw.textbbox((0, 0), text, font=font)
+def composite_label(image, text, font_size=200):
+    """
+    Draws the label onto an RGB image in place. Only the label's bounding
+    region is converted to RGBA for blending; the rest of the image is
+    left untouched.
+    """
+    (width, height) = image.size
 
-        padding = font_size // 2
-        box_width = text_bbox[2] - text_bbox[0] + padding * 2
-        box_height = text_bbox[3] - text_bbox[1] + padding * 2
+    text_position = (int(width / 2), int(height * 0.75))
 
-        background = Image.new("RGBA", (box_width, box_height), (0, 0, 0, 0))
-        bg_draw = ImageDraw.Draw(background)
+    pixel_color = image.getpixel((int(width / 2), int(height / 2)))
 
-        bg_draw.rounded_rectangle([0, 0, box_width, box_height], radius=20, fill=pixel_color)
+    text_color = get_text_color(pixel_color)
 
-        text_layer = Image.new("RGBA", (box_width, box_height), (0, 0, 0, 0))
-        text_draw = ImageDraw.Draw(text_layer)
+    rotated_text = colorize(rotated_label_mask(text, font_size, 1, random.randint(-3, 3)), text_color)
+    rotated_background = colorize(rotated_label_mask(text, font_size, 0, random.randint(-3, 3)), pixel_color)
 
-        text_draw.text((padding, padding), text, font=font, fill=text_color)
+    label = Image.new("RGBA", (max(rotated_text.size[0], rotated_background.size[0]),
+                               max(rotated_text.size[1], rotated_background.size[1])), (0, 0, 0, 0))
+    label.alpha_composite(rotated_background)
+    label.alpha_composite(rotated_text)
 
-        rotated_text = text_layer.rotate(random.randint(-3, 3), expand=1)
-        rotated_background = background.rotate(random.randint(-3, 3), expand=1)
+    rotated_position = (text_position[0] - rotated_text.size[0] // 2, text_position[1] - rotated_text.size[1] // 2)
+
+    left = max(rotated_position[0], 0)
+    top = max(rotated_position[1], 0)
+    right = min(rotated_position[0] + label.size[0], width)
+    bottom = min(rotated_position[1] + label.size[1], height)
+    if right <= left or bottom <= top:
+        return image
+
+    region = image.crop((left, top, right, bottom)).convert("RGBA")
+    region.alpha_composite(label, source=(left - rotated_position[0], top - rotated_position[1]))
+    image.paste(region.convert("RGB"), (left, top))
+    return image
+
+
+def add_text_with_rounded_background(text, image_path, font_size=200, quality=JPEG_QUALITY, output_format="JPEG"):
+    try:
+        if not os.path.exists(image_path):
+            logging.error(f"Файл зображення не знайдено: {image_path}")
+            return None
+
+        try:
+            load_font(FONT_PATH, font_size)
+        except OSError:
+            logging.error(f"Файл шрифту не знайдено за шляхом: {FONT_PATH}")
+            return None
 
-        rotated_position = (text_position[0] - rotated_text.size[0] // 2, text_position[1] - rotated_text.size[1] // 2)
+        image = Image.open(image_path)
+        exif = image.info.get("exif") or b""
+        if image.mode != "RGB":
+            image = image.convert("RGB")
 
-        image.paste(rotated_background, rotated_position, rotated_background)
-        image.paste(rotated_text, rotated_position, rotated_text)
+        composite_label(image, text, font_size)
 
         output_path = image_path
-        image.save(output_path, "PNG")
+        image.save(output_path, output_format, quality=quality, exif=exif)
 
         logging.info(f"Текст додано до зображення: {output_path}")
         return output_path
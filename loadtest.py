@@ -0,0 +1,210 @@
+"""
+Offline load test of the scheduler, dispatcher and session manager.
+
+Runs main.py's pipeline against fakes.FakeTable, fakes.StubWebDriver and a
+fake AdsPower API (fake_adspower.py), so no Airtable, AdsPower or Chrome is
+needed. Seeds posts due over the next few minutes, waits for every job to
+finish and reports throughput and p50/p95/p99 latency for each leg.
+
+    python loadtest.py --posts 200 --accounts 20 --browsers 3 --minutes 2
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from fake_adspower import start_fake_adspower
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def write_config(folder, args, ads_url):
+    settings = {
+        'BACKEND': 'fake',
+        'ADS_API_URL': ads_url,
+        'ADS_RELEASE_POLL_INTERVAL': 0.05,
+        'MAX_BROWSERS': args.browsers,
+        'POST_BACKLOG': args.backlog,
+        'BROWSER_IDLE_TTL': args.idle_ttl,
+        'POST_TIMEZONE': 'UTC',
+        'AIRTABLE_SYNC_INTERVAL': args.sync_interval,
+        'AIRTABLE_FLUSH_INTERVAL': 1,
+        'FAKE_TABLE_LATENCY': args.table_latency,
+        'FAKE_TABLE_FAILURE_RATE': args.table_failure_rate,
+        'FAKE_DRIVER_LATENCY': args.driver_latency,
+        'FAKE_DRIVER_FAILURE_RATE': args.driver_failure_rate,
+        'PACING_MIN_DELAY': 0,
+        'PACING_MAX_DELAY': 0,
+        'METRICS_PORT': 0,
+    }
+    with open(os.path.join(folder, 'config.txt'), 'w', encoding='utf-8') as f:
+        f.write('[DEFAULT]\n')
+        for key, value in settings.items():
+            f.write(f'{key} = {value}\n')
+
+    with open(os.path.join(folder, 'config_ads_account.txt'), 'w', encoding='utf-8') as f:
+        for index in range(args.accounts):
+            f.write(f'[account{index}]\nprofile_serial_number = ads{index}\nusername = account{index}\n'
+                    f'password = secret\nclose = {str(index % 2 == 0)}\n\n')
+
+
+def seed_posts(table, args):
+    """Spreads posts over args.minutes minutes, starting with the current one. Returns {record_id: due}."""
+    first_minute = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    due_times = {}
+    for index in range(args.posts):
+        due = first_minute + timedelta(minutes=index * args.minutes // args.posts)
+        record = table.insert({
+            'Scheduled?': True,
+            'Date': due.strftime('%Y-%m-%d'),
+            'Time': due.strftime('%H:%M'),
+            'Account': f'account{random.randrange(args.accounts)}',
+            'Subreddit': 'test',
+            'Title': f'Load test post {index}',
+            'Flair': 'test',
+        })
+        due_times[record['id']] = due.timestamp()
+    return due_times
+
+
+class Timeline:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dispatched = {}
+        self.started = {}
+        self.finished = {}
+        self.outcomes = {}
+        self.done = threading.Event()
+        self.expected = 0
+
+    def mark(self, kind, record_id):
+        with self.lock:
+            getattr(self, kind).setdefault(record_id, time.time())
+
+    def finish(self, record_id, outcome):
+        with self.lock:
+            self.finished[record_id] = time.time()
+            self.outcomes[record_id] = outcome
+            if len(self.finished) >= self.expected:
+                self.done.set()
+
+
+def instrument(main, timeline):
+    dispatch = main.post_scheduler.dispatch
+
+    def timed_dispatch(record):
+        timeline.mark('dispatched', record['id'])
+        dispatch(record)
+
+    main.post_scheduler.dispatch = timed_dispatch
+
+    run_posting_job = main.run_posting_job
+
+    def timed_job(record_id, *args, **kwargs):
+        timeline.mark('started', record_id)
+        outcome = None
+        try:
+            outcome = run_posting_job(record_id, *args, **kwargs)
+            return outcome
+        finally:
+            timeline.finish(record_id, outcome)
+
+    main.run_posting_job = timed_job
+
+
+def report(timeline, due_times, seeded_at, table, ads_state, elapsed):
+    def leg(name, start, end):
+        values = [(end[rid] - max(start[rid], seeded_at)) * 1000 for rid in end if rid in start]
+        if not values:
+            print(f"{name:<28} no samples")
+            return
+        print(f"{name:<28} n={len(values):<5} p50={percentile(values, 0.5):>9.1f} ms "
+              f"p95={percentile(values, 0.95):>9.1f} ms p99={percentile(values, 0.99):>9.1f} ms "
+              f"max={max(values):>9.1f} ms")
+
+    print(f"\nFinished {len(timeline.finished)}/{timeline.expected} jobs in {elapsed:.1f}s")
+    if timeline.started and timeline.finished:
+        busy = max(timeline.finished.values()) - min(timeline.started.values())
+        print(f"Throughput: {len(timeline.finished) / busy:.2f} posts/s over {busy:.1f}s of posting")
+    leg('due -> dispatched', due_times, timeline.dispatched)
+    leg('dispatched -> job started', timeline.dispatched, timeline.started)
+    leg('job started -> finished', timeline.started, timeline.finished)
+    leg('due -> finished', due_times, timeline.finished)
+
+    results = {}
+    for outcome in timeline.outcomes.values():
+        key = 'success' if outcome is not None and outcome.success else \
+            f"failure at {outcome.stage if outcome is not None else 'job error'}"
+        results[key] = results.get(key, 0) + 1
+    print(f"Outcomes: {results}")
+
+    browser_starts = sum(1 for path, _ in ads_state.calls if path == '/api/v1/browser/start')
+    print(f"Browser starts: {browser_starts} for {len(timeline.started)} jobs")
+    print(f"Airtable calls: {table.calls}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Offline load test of the posting pipeline")
+    arg_parser.add_argument("--posts", type=int, default=100)
+    arg_parser.add_argument("--accounts", type=int, default=10)
+    arg_parser.add_argument("--minutes", type=int, default=1, help="spread posts over this many minutes")
+    arg_parser.add_argument("--browsers", type=int, default=3)
+    arg_parser.add_argument("--backlog", type=int, default=10)
+    arg_parser.add_argument("--idle-ttl", type=int, default=120)
+    arg_parser.add_argument("--sync-interval", type=int, default=2)
+    arg_parser.add_argument("--table-latency", type=float, default=0.05)
+    arg_parser.add_argument("--table-failure-rate", type=float, default=0.0)
+    arg_parser.add_argument("--driver-latency", type=float, default=0.005)
+    arg_parser.add_argument("--driver-failure-rate", type=float, default=0.0)
+    arg_parser.add_argument("--ads-latency", type=float, default=0.05)
+    arg_parser.add_argument("--ads-failure-rate", type=float, default=0.0)
+    arg_parser.add_argument("--real-delays", action="store_true",
+                            help="keep the human-like random delays around login")
+    arg_parser.add_argument("--timeout", type=int, default=900)
+    args = arg_parser.parse_args()
+
+    ads_server, ads_state = start_fake_adspower(latency=args.ads_latency, failure_rate=args.ads_failure_rate)
+    work_folder = tempfile.mkdtemp(prefix='loadtest_')
+    write_config(work_folder, args, f"http://127.0.0.1:{ads_server.server_port}")
+    os.environ['CONFIG_PATH'] = os.path.join(work_folder, 'config.txt')
+    os.environ['ADS_ACCOUNTS_PATH'] = os.path.join(work_folder, 'config_ads_account.txt')
+    os.chdir(work_folder)
+    sys.path.insert(0, HERE)
+
+    import main as poster
+
+    if not args.real_delays:
+        poster.random_delay = lambda min_seconds=0, max_seconds=0: None
+
+    timeline = Timeline()
+    timeline.expected = args.posts
+    instrument(poster, timeline)
+    due_times = seed_posts(poster.table, args)
+    seeded_at = time.time()
+
+    for target in (poster.add_posts_to_cache, poster.post_scheduler.run, poster.session_manager.run_reaper,
+                   poster.airtable_writer.run, poster.process_post_cache_selenium):
+        threading.Thread(target=target, daemon=True).start()
+
+    print(f"Seeded {args.posts} posts over {args.minutes} minute(s) for {args.accounts} accounts, "
+          f"{args.browsers} browsers; working in {work_folder}")
+    if not timeline.done.wait(args.timeout):
+        print(f"Timed out after {args.timeout}s")
+    elapsed = time.time() - seeded_at
+    report(timeline, due_times, seeded_at, poster.table, ads_state, elapsed)
+    return 0 if len(timeline.finished) == args.posts else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,128 @@
+import atexit
+import json
 import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 
+from config_service import registry
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+CONTEXT_FIELDS = ('job_id', 'ads_id', 'stage', 'elapsed_ms')
 
-def log_interface(message, level="info"):
+log_context_state = threading.local()
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Attaches fields (job_id, ads_id, stage, ...) to every record logged from
+    this thread inside the block. elapsed_ms counts from the outermost block.
+    """
+    previous = getattr(log_context_state, 'fields', {})
+    fields = {**previous, **fields}
+    fields.setdefault('started', time.monotonic())
+    log_context_state.fields = fields
+    try:
+        yield
+    finally:
+        log_context_state.fields = previous
+
+
+def update_log_context(**fields):
+    current = getattr(log_context_state, 'fields', None)
+    if current is not None:
+        current.update(fields)
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        fields = getattr(log_context_state, 'fields', {})
+        for key, value in fields.items():
+            if key != 'started' and not hasattr(record, key):
+                setattr(record, key, value)
+        if 'started' in fields and not hasattr(record, 'elapsed_ms'):
+            record.elapsed_ms = int((time.monotonic() - fields['started']) * 1000)
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        fields = ' '.join(f"{key}={getattr(record, key)}" for key in CONTEXT_FIELDS
+                          if getattr(record, key, None) is not None)
+        return f"{message} [{fields}]" if fields else message
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key in CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def json_log_path():
+    try:
+        return registry.get('LOG_JSON_PATH', '')
+    except Exception:
+        return ''
+
+
+def setup_logging():
+    """
+    Log calls only put the record on a queue; a listener thread formats it
+    and writes to stderr and, if LOG_JSON_PATH is set, a JSON-lines file.
+    """
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(TextFormatter(LOG_FORMAT))
+    handlers = [stream_handler]
+
+    path = json_log_path()
+    if path:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_handler = logging.FileHandler(path, encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    # the listener's handlers do the real formatting; this only merges args into msg
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    queue_handler.addFilter(ContextFilter())
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    # force: reading the config may already have logged through an implicit basicConfig
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler], force=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
+
+
+def log_interface(message, level="info", **fields):
 
     if level == "info":
-        logging.info(message)
+        logging.info(message, extra=fields)
     elif level == "warn":
-        logging.warning(message)
+        logging.warning(message, extra=fields)
     elif level == "error":
-        logging.error(message)
+        logging.error(message, extra=fields)
     elif level == "success":
-        logging.info(f"SUCCESS: {message}")
+        logging.info(f"SUCCESS: {message}", extra=fields)
     else:
-        logging.info(message)
+        logging.info(message, extra=fields)
@@ -6,11 +6,17 @@ import re
 import random
 import threading
 import uuid
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+import base64
+from collections import deque, OrderedDict
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import queue
 import requests
-import configparser
+from requests.adapters import HTTPAdapter
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.ui import WebDriverWait
@@ -22,152 +28,680 @@ from pyairtable import Api
 from dateutil import parser
 import pytz
 import urllib3
-from driver import get_driver, close_driver
-from file_workers.config_service import get_config
-from image_lib import input_image_path
-from image_text import add_text_with_rounded_background
+from driver import get_driver, close_driver, set_webdriver_factory
+from logger import log_context, update_log_context
+from metrics import REGISTRY, POSTS_TOTAL, POST_STEP_SECONDS, stage_timer, timed, start_metrics_server
+from config_service import get_config, registry
+from image_lib import prepare_image, PREPARED_FOLDER
+from media_cache import MediaCache, media_cache_key
 
 urllib3.disable_warnings()
 logging.basicConfig(level=logging.INFO)
 
 post_cache = queue.Queue()
-RECORDS = []
-POSTS_ON_WORK = []
+RECORDS = {}
+RECORDS_LOCK = threading.Lock()
 general_config, accounts_config = get_config()
 
+BACKEND = general_config.get('BACKEND', 'airtable')
 AIRTABLE_API_KEY = general_config.get('AIRTABLE_API_KEY')
 AIRTABLE_BASE_ID = general_config.get('AIRTABLE_BASE_ID')
 AIRTABLE_TABLE_NAME = general_config.get('AIRTABLE_TABLE_NAME')
+AIRTABLE_MODIFIED_FIELD = general_config.get('AIRTABLE_MODIFIED_FIELD', 'Last Modified')
+AIRTABLE_SYNC_INTERVAL = int(general_config.get('AIRTABLE_SYNC_INTERVAL', 20))
+AIRTABLE_FULL_SYNC_INTERVAL = int(general_config.get('AIRTABLE_FULL_SYNC_INTERVAL', 900))
+AIRTABLE_SYNC_OVERLAP = 5
+AIRTABLE_FLUSH_INTERVAL = float(general_config.get('AIRTABLE_FLUSH_INTERVAL', 5))
+AIRTABLE_BATCH_SIZE = 10
+AIRTABLE_WRITE_ATTEMPTS = 3
+# outcome columns are opt-in: name them in config.txt once they exist in the table
+AIRTABLE_STATUS_FIELD = general_config.get('AIRTABLE_STATUS_FIELD', '')
+AIRTABLE_PERMALINK_FIELD = general_config.get('AIRTABLE_PERMALINK_FIELD', '')
+AIRTABLE_FAILURE_STAGE_FIELD = general_config.get('AIRTABLE_FAILURE_STAGE_FIELD', '')
+AIRTABLE_DURATION_FIELD = general_config.get('AIRTABLE_DURATION_FIELD', '')
+POST_TIMEZONE = general_config.get('POST_TIMEZONE', 'Europe/London')
+POST_LATE_GRACE = int(general_config.get('POST_LATE_GRACE', 120))
+MAX_BROWSERS = int(general_config.get('MAX_BROWSERS', 3))
+POST_BACKLOG = int(general_config.get('POST_BACKLOG', 10))
+BROWSER_IDLE_TTL = int(general_config.get('BROWSER_IDLE_TTL', 120))
+MEDIA_MAX_BYTES = int(general_config.get('MEDIA_MAX_MB', 512)) * 1024 * 1024
+MEDIA_DOWNLOAD_TIMEOUT = (10, int(general_config.get('MEDIA_READ_TIMEOUT', 60)))
+MEDIA_DOWNLOAD_RETRIES = 3
+MEDIA_CHUNK_SIZE = 1024 * 1024
+MEDIA_CACHE_MAX_BYTES = int(general_config.get('MEDIA_CACHE_MAX_MB', 2048)) * 1024 * 1024
+TEMP_MAX_AGE = int(general_config.get('TEMP_MAX_AGE_HOURS', 12)) * 3600
+PREFETCH_LEAD = int(general_config.get('PREFETCH_MINUTES', 10)) * 60
+MEDIA_WORKERS = int(general_config.get('MEDIA_WORKERS', 2))
+IMAGE_WORKERS = int(general_config.get('IMAGE_WORKERS', 2))
+UPLOAD_JPEG_QUALITY = int(general_config.get('UPLOAD_JPEG_QUALITY', 90))
+PACING_MIN_DELAY = float(general_config.get('PACING_MIN_DELAY', 0.5))
+PACING_MAX_DELAY = float(general_config.get('PACING_MAX_DELAY', 1.5))
+STEP_TIMEOUT = int(general_config.get('STEP_TIMEOUT', 20))
+UPLOAD_TIMEOUT = int(general_config.get('UPLOAD_TIMEOUT', 120))
+SCREENSHOT_MODE = general_config.get('SCREENSHOT_MODE', 'viewport')
+SCREENSHOT_MAX_HEIGHT = int(general_config.get('SCREENSHOT_MAX_HEIGHT', 4000))
+SCREENSHOT_QUALITY = int(general_config.get('SCREENSHOT_QUALITY', 70))
+METRICS_PORT = int(general_config.get('METRICS_PORT', 9108))
+DISPATCH_POLL_TIMEOUT = 5
+
+if BACKEND == 'fake':
+    # offline run: in-memory table and stub browsers; point ADS_API_URL at fake_adspower.py
+    from fakes import FakeTable, StubWebDriver
+
+    fake_table_path = general_config.get('FAKE_TABLE_PATH')
+    fake_table_options = {
+        'latency': float(general_config.get('FAKE_TABLE_LATENCY', 0)),
+        'failure_rate': float(general_config.get('FAKE_TABLE_FAILURE_RATE', 0)),
+        'modified_field': AIRTABLE_MODIFIED_FIELD,
+    }
+    table = FakeTable.from_json(fake_table_path, **fake_table_options) if fake_table_path \
+        else FakeTable(**fake_table_options)
+    set_webdriver_factory(StubWebDriver.factory(
+        latency=float(general_config.get('FAKE_DRIVER_LATENCY', 0)),
+        failure_rate=float(general_config.get('FAKE_DRIVER_FAILURE_RATE', 0)),
+    ))
+else:
+    airtable_api = Api(AIRTABLE_API_KEY)
+    table = airtable_api.table(AIRTABLE_BASE_ID, AIRTABLE_TABLE_NAME)
+
+media_session = requests.Session()
+media_session.mount('https://', HTTPAdapter(pool_maxsize=MAX_BROWSERS + 2))
+media_cache = MediaCache('temp/cache', MEDIA_CACHE_MAX_BYTES)
+
+
+def new_image_pool():
+    # spawn, not fork: forking a process that already runs browser and sync threads can copy held locks
+    return ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+image_pool = new_image_pool()
+image_pool_lock = threading.Lock()
 
-airtable_api = Api(AIRTABLE_API_KEY)
-table = airtable_api.table(AIRTABLE_BASE_ID, AIRTABLE_TABLE_NAME)
 
-
-def load_config(file_path):
-    config = {}
-    try:
-        with open(file_path, 'r') as file:
-            for line in file:
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.strip().split('=', 1)
-                    config[key.strip()] = value.strip()
-
-    except FileNotFoundError:
-        logging.error(f" {file_path} not found .")
-    except Exception as e:
-        logging.error(f"{file_path}: {e}")
-    return config
+class Account:
+    def __init__(self, username, psswd):
+        self.username = username
+        self.psswd = psswd
 
 
-def load_ads_accounts_config(file_path):
-    config = configparser.ConfigParser()
-    accounts_config = []
+def shutdown_driver(ads_id, driver, close_browser):
     try:
-        config.read(file_path)
-        if not config.sections():
-            return accounts_config
+        if close_browser:
+            close_driver(ads_id)
+        else:
+            driver.quit()
+    except Exception as e:
+        logging.error(f"Error closing browser {ads_id}: {e}")
 
-        for section in config.sections():
-            profile_serial_number = config.get(section, 'profile_serial_number', fallback=None)
-            username = config.get(section, 'username', fallback=None)
-            password = config.get(section, 'password', fallback=None)
-            close = config.getboolean(section, 'close', fallback=False)
-            accounts_config.append((section, profile_serial_number, username, password, close))
 
+class SessionManager:
+    """
+    Tracks which AdsPower profiles are in use. Each profile is owned by at
+    most one job; other jobs for the same profile wait in a FIFO queue and
+    are handed the profile directly by end_session.
+
+    Drivers released with release() stay attached for idle_ttl seconds so
+    the next job on the same profile can reuse them. Idle drivers are
+    evicted least recently used first once max_browsers are open. An
+    evicted profile stays owned until its browser has been shut down, so
+    no job can start it again while AdsPower is still stopping it. A cold
+    start reserves its slot before calling AdsPower, so overlapping starts
+    cannot open more than max_browsers between them.
+    """
+
+    def __init__(self, max_browsers=3, idle_ttl=0):
+        self.max_browsers = max_browsers
+        self.idle_ttl = idle_ttl
+        self.lock = threading.Lock()
+        self.active_sessions = {}
+        self.waiters = {}
+        self.idle = OrderedDict()
+        self.browsers_in_use = 0
+        self.starting = 0
+        self.closing = 0
+        self.slot_freed = threading.Condition(self.lock)
 
-    except Exception as e:
-        logging.error(f"Error {file_path}: {e}")
+    def is_session_active(self, ads_id):
+        with self.lock:
+            return self.active_sessions.get(ads_id, False)
 
-    return accounts_config
+    def acquire(self, ads_id, timeout=None):
+        with self.lock:
+            waiters = self.waiters.setdefault(ads_id, deque())
+            if not self.active_sessions.get(ads_id, False) and not waiters:
+                self.active_sessions[ads_id] = True
+                return True
+            event = threading.Event()
+            waiters.append(event)
 
+        if event.wait(timeout):
+            return True
+        with self.lock:
+            if event.is_set():
+                return True
+            waiters = self.waiters.get(ads_id)
+            if waiters and event in waiters:
+                waiters.remove(event)
+            return False
 
-config = load_config('config.txt')
+    def take_idle(self, ads_id):
+        """Moves a live idle browser for ads_id into use; its slot is never left uncounted."""
+        with self.lock:
+            entry = self.idle.pop(ads_id, None)
+            if entry is None:
+                return None
+            self.browsers_in_use += 1
+        driver, close_browser, _ = entry
+        try:
+            driver.current_url
+            return driver
+        except Exception:
+            shutdown_driver(ads_id, driver, close_browser)
+            with self.lock:
+                self.browsers_in_use -= 1
+                self.slot_freed.notify_all()
+            return None
 
-ads_accounts_config = load_ads_accounts_config('config_ads_account.txt')
+    def claim_idle_locked(self, ads_id):
+        """Takes an unowned idle browser for shutdown; the profile stays owned until close_claimed."""
+        driver, close_browser, _ = self.idle.pop(ads_id)
+        self.active_sessions[ads_id] = True
+        self.closing += 1
+        return driver, close_browser
 
+    def close_claimed(self, ads_id, driver, close_browser):
+        try:
+            shutdown_driver(ads_id, driver, close_browser)
+        finally:
+            with self.lock:
+                self.closing -= 1
+                self.slot_freed.notify_all()
+            self.end_session(ads_id)
+
+    def open_browsers_locked(self):
+        return self.browsers_in_use + self.starting + len(self.idle) + self.closing
+
+    def make_room(self):
+        """Reserves a slot for a cold start, evicting or waiting as needed. Undo with start_finished."""
+        while True:
+            with self.lock:
+                if self.open_browsers_locked() < self.max_browsers:
+                    self.starting += 1
+                    return
+                ads_id = next((idle_id for idle_id in self.idle
+                               if not self.active_sessions.get(idle_id, False)), None)
+                if ads_id is None:
+                    # every slot is in use, starting or closing; wait for one to free up
+                    self.slot_freed.wait(timeout=5)
+                    continue
+                driver, close_browser = self.claim_idle_locked(ads_id)
+            logging.info(f"Evicting idle browser {ads_id}")
+            self.close_claimed(ads_id, driver, close_browser)
+
+    def start_finished(self, started):
+        with self.lock:
+            self.starting -= 1
+            if started:
+                self.browsers_in_use += 1
+            else:
+                self.slot_freed.notify_all()
 
-class Account:
-    def __init__(self, username, psswd):
-        self.username = username
-        self.psswd = psswd
+    def start_session(self, ads_id, timeout=None):
+        """Returns (driver, warm); driver is None if the browser failed to start."""
+        if not ads_id or not isinstance(ads_id, str):
+            logging.error(f"AdsPower ID not corect: {ads_id}")
+            return None, False
 
+        if not self.acquire(ads_id, timeout):
+            logging.error(f"Timed out waiting for AdsPower ID: {ads_id}")
+            return None, False
 
-class SessionManager:
-    def __init__(self):
-        self.active_sessions = {}
+        driver = self.take_idle(ads_id)
+        warm = driver is not None
+        if warm:
+            return driver, True
 
-    def is_session_active(self, ads_id):
-        return self.active_sessions.get(ads_id, False)
+        self.make_room()
+        try:
+            driver = get_driver(ads_id)
+        except Exception as e:
+            driver = None
+        self.start_finished(bool(driver))
+        if not driver:
+            self.end_session(ads_id)
+            return None, False
+        return driver, False
+
+    def release(self, ads_id, driver, close_browser):
+        with self.lock:
+            self.browsers_in_use -= 1
+            self.slot_freed.notify_all()
+            # park only while the idle browser fits under the cap next to everything else open
+            if self.idle_ttl > 0 and self.open_browsers_locked() < self.max_browsers:
+                self.idle[ads_id] = (driver, close_browser, time.time())
+                self.idle.move_to_end(ads_id)
+                driver = None
+        if driver is not None:
+            shutdown_driver(ads_id, driver, close_browser)
+        self.end_session(ads_id)
 
-    def start_session(self, ads_id):
-        if not self.is_session_active(ads_id):
+    def end_session(self, ads_id):
+        with self.lock:
+            waiters = self.waiters.get(ads_id)
+            if waiters:
+                waiters.popleft().set()
+                return
+            self.active_sessions[ads_id] = False
+            self.waiters.pop(ads_id, None)
+
+    def evict_expired(self):
+        now = time.time()
+        with self.lock:
+            expired = [ads_id for ads_id, entry in self.idle.items()
+                       if now - entry[2] >= self.idle_ttl and not self.active_sessions.get(ads_id, False)]
+            entries = [(ads_id, self.claim_idle_locked(ads_id)) for ads_id in expired]
+        for ads_id, (driver, close_browser) in entries:
+            logging.info(f"Closing idle browser {ads_id}")
+            self.close_claimed(ads_id, driver, close_browser)
+
+    def run_reaper(self, interval=5):
+        while True:
+            time.sleep(interval)
+            self.evict_expired()
+
+
+session_manager = SessionManager(MAX_BROWSERS, BROWSER_IDLE_TTL)
+
+
+class PostingExecutor:
+    """
+    Thread pool that runs at most max_workers posting jobs at once and
+    queues up to max_backlog more. submit() blocks the caller while the
+    backlog is full. Finished results are kept for collect_results().
+
+    Jobs submitted with a key (the AdsPower profile) run one per key: while
+    one is running, later jobs for that key wait here instead of blocking a
+    worker, and each finished job hands the worker on to its key's next job.
+    """
+
+    def __init__(self, max_workers, max_backlog, max_results=1000):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='posting')
+        self.slots = threading.BoundedSemaphore(max_workers + max_backlog)
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.waiting = {}
+        self.results = deque(maxlen=max_results)
+
+    def submit(self, job_id, fn, *args, key=None):
+        """Returns the job's future, or None if it is waiting behind another job for key."""
+        self.slots.acquire()
+        if key is not None:
+            with self.lock:
+                if key in self.waiting:
+                    self.waiting[key].append((job_id, fn, args))
+                    return None
+                self.waiting[key] = deque()
+        try:
+            return self.start(job_id, key, fn, args)
+        except Exception:
+            self.start_next(key)
+            raise
 
-            if not ads_id or not isinstance(ads_id, str):
-                logging.error(f"AdsPower ID not corect: {ads_id}")
-                return None
+    def start(self, job_id, key, fn, args):
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.futures[job_id] = future
+        future.add_done_callback(lambda f: self.on_done(job_id, key, f))
+        return future
+
+    def start_next(self, key):
+        while key is not None:
+            with self.lock:
+                queued = self.waiting.get(key)
+                if not queued:
+                    self.waiting.pop(key, None)
+                    return
+                job_id, fn, args = queued.popleft()
+            try:
+                self.start(job_id, key, fn, args)
+                return
+            except Exception as e:
+                logging.error(f"Posting job {job_id} could not be started: {e}")
 
+    def on_done(self, job_id, key, future):
+        self.slots.release()
+        with self.lock:
+            self.futures.pop(job_id, None)
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.error(f"Posting job {job_id} failed: {e}")
+            result = None
+        self.results.append((job_id, result))
+        self.start_next(key)
+
+    def pending(self):
+        with self.lock:
+            return len(self.futures) + sum(len(queued) for queued in self.waiting.values())
+
+    def collect_results(self):
+        results = []
+        while self.results:
+            results.append(self.results.popleft())
+        return results
+
+
+posting_executor = PostingExecutor(MAX_BROWSERS, POST_BACKLOG)
+
+
+class AirtableWriter:
+    """
+    Write-behind queue for Airtable updates. Fields queued for the same
+    record and group are merged until the next flush, which sends them with
+    batch_update in chunks of batch_size records. Groups are never merged,
+    so a rejected optional column cannot take the 'status' update (the
+    Scheduled? flag) down with it. A chunk that fails is retried record by
+    record so one bad record does not drop the rest.
+    """
+
+    def __init__(self, table, flush_interval=5, batch_size=10, max_attempts=3):
+        self.table = table
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = OrderedDict()
+        self.attempts = {}
+
+    def update(self, record_id, fields, group='status'):
+        if not fields:
+            return
+        with self.lock:
+            self.pending.setdefault((record_id, group), {}).update(fields)
+            if len(self.pending) >= self.batch_size:
+                self.wakeup.set()
+
+    def requeue(self, key, fields):
+        with self.lock:
+            attempts = self.attempts.get(key, 0) + 1
+            if attempts >= self.max_attempts:
+                self.attempts.pop(key, None)
+                logging.error(f"Dropping Airtable update for {key[0]} after {attempts} attempts: {fields}")
+                return
+            self.attempts[key] = attempts
+            # fields queued since this flush started are newer and win
+            self.pending[key] = {**fields, **self.pending.get(key, {})}
+
+    def make_batches(self, items):
+        """Chunks of at most batch_size updates, each record at most once per chunk."""
+        batches = []
+        for key, fields in items:
+            if not batches or len(batches[-1]) >= self.batch_size or \
+                    any(other[0] == key[0] for other, _ in batches[-1]):
+                batches.append([])
+            batches[-1].append((key, fields))
+        return batches
+
+    def flush(self):
+        with self.lock:
+            items = list(self.pending.items())
+            self.pending.clear()
+
+        for batch in self.make_batches(items):
             try:
-                driver = get_driver(ads_id)
+                self.table.batch_update([{'id': key[0], 'fields': fields} for key, fields in batch])
             except Exception as e:
-                return None
+                logging.error(f"Airtable batch update of {len(batch)} records failed: {e}")
+                for key, fields in batch:
+                    try:
+                        self.table.update(key[0], fields)
+                    except Exception as e:
+                        logging.error(f"Airtable update for {key[0]} failed: {e}")
+                        self.requeue(key, fields)
+                        continue
+                    with self.lock:
+                        self.attempts.pop(key, None)
+                continue
+            with self.lock:
+                for key, _ in batch:
+                    self.attempts.pop(key, None)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing Airtable updates: {e}")
 
-            if driver:
-                self.active_sessions[ads_id] = True
-                return driver
-        return None
 
-    def end_session(self, ads_id):
-        self.active_sessions[ads_id] = False
+airtable_writer = AirtableWriter(table, AIRTABLE_FLUSH_INTERVAL, AIRTABLE_BATCH_SIZE, AIRTABLE_WRITE_ATTEMPTS)
+
+
+class PostOutcome:
+    """Result of one posting job; stage is the last step that was started."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stage_started = self.started
+        self._stage = 'queued'
+        self.success = False
+        self.permalink = None
+        self.duration = None
+
+    @property
+    def stage(self):
+        return self._stage
+
+    @stage.setter
+    def stage(self, stage):
+        self.observe_step()
+        self._stage = stage
+        update_log_context(stage=stage)
+
+    def observe_step(self):
+        now = time.monotonic()
+        if self._stage != 'queued':
+            POST_STEP_SECONDS.observe(now - self.stage_started, step=self._stage)
+        self.stage_started = now
+
+    def finish(self, success):
+        self.observe_step()
+        self.success = bool(success)
+        self.duration = round(time.monotonic() - self.started, 1)
+        POSTS_TOTAL.inc(result='success' if self.success else 'failure', stage=self._stage)
+
+    def fields(self):
+        values = {
+            AIRTABLE_STATUS_FIELD: 'Posted' if self.success else 'Failed',
+            AIRTABLE_PERMALINK_FIELD: self.permalink,
+            AIRTABLE_FAILURE_STAGE_FIELD: None if self.success else self.stage,
+            AIRTABLE_DURATION_FIELD: self.duration,
+        }
+        # a field left blank in config.txt is not written
+        return {name: value for name, value in values.items() if name}
 
 
-session_manager = SessionManager()
 def get_ads_account_data(account_name):
-    for account in ads_accounts_config:
-        if account[0] == account_name:
-            profile_serial_number = account[1]
-            password = account[3]
-            return str(profile_serial_number), str(password)
-    return None, None
+    account = registry.account(account_name)
+    if account is None:
+        return None, None
+    return str(account.ads_id), str(account.password)
+
 
+def build_sync_formula(since=None):
+    if since is None:
+        return "{Scheduled?}"
+    since_str = since.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    return f"IS_AFTER({{{AIRTABLE_MODIFIED_FIELD}}}, DATETIME_PARSE('{since_str}'))"
 
-def get_data_from_airtable():
+
+def get_data_from_airtable(since=None):
     try:
-        records = table.all()
-        logging.info(f" {len(records)} in Airtable.") if records else logging.info("Error")
+        records = table.all(formula=build_sync_formula(since))
+        logging.info(f" {len(records)} in Airtable.")
         return records
     except Exception as e:
         logging.error(f"Error Airtable: {e}")
-        return []
+        return None
 
+@timed('download_media', falsy_is_failure=True)
 def download_media(media_url):
+    """
+    Streams the attachment into temp/ in MEDIA_CHUNK_SIZE chunks through the
+    shared media_session. Interrupted transfers are resumed with a Range
+    request; files larger than MEDIA_MAX_BYTES are rejected.
+    """
+    file_id = uuid.uuid4()
+    part_path = f"temp/{file_id}.part"
     try:
-        response = requests.get(media_url)
-        response.raise_for_status()
-        content_type = response.headers.get('Content-Type', '')
-        suffix = '.jpg' if 'image/' in content_type else '.mp4' if 'video/' in content_type else None
-
-        if not suffix:
-            logging.error(f"TypeError media: {content_type}")
-            return None
-
-        filename = f"temp/{uuid.uuid4()}{suffix}"
         os.makedirs("temp", exist_ok=True)
-        with open(filename, "wb") as f:
-            f.write(response.content)
-
+        suffix = None
+        written = 0
+        for attempt in range(MEDIA_DOWNLOAD_RETRIES + 1):
+            headers = {'Range': f'bytes={written}-'} if written else {}
+            try:
+                with media_session.get(media_url, stream=True, timeout=MEDIA_DOWNLOAD_TIMEOUT,
+                                       headers=headers) as response:
+                    response.raise_for_status()
+                    if suffix is None:
+                        content_type = response.headers.get('Content-Type', '')
+                        suffix = '.jpg' if 'image/' in content_type else '.mp4' if 'video/' in content_type else None
+                        if not suffix:
+                            logging.error(f"TypeError media: {content_type}")
+                            return None
+
+                    if written and response.status_code != 206:
+                        written = 0
+                    content_length = int(response.headers.get('Content-Length') or 0)
+                    if written + content_length > MEDIA_MAX_BYTES:
+                        logging.error(f"Media too large ({written + content_length} bytes): {media_url}")
+                        return None
+
+                    with open(part_path, "ab" if written else "wb") as f:
+                        for chunk in response.iter_content(MEDIA_CHUNK_SIZE):
+                            written += len(chunk)
+                            if written > MEDIA_MAX_BYTES:
+                                logging.error(f"Media exceeds {MEDIA_MAX_BYTES} bytes: {media_url}")
+                                return None
+                            f.write(chunk)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == MEDIA_DOWNLOAD_RETRIES:
+                    raise
+                logging.warning(f"Download interrupted at {written} bytes, retrying: {e}")
+                time.sleep(2 ** attempt)
+
+        filename = f"temp/{file_id}{suffix}"
+        os.replace(part_path, filename)
         logging.info(f"Download media: {filename}")
         return os.path.abspath(filename)
     except Exception as e:
+        logging.error(f"Error downloading media {media_url}: {e}")
         return None
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
 
 
-def process_image(image_path):
-    try:
-        return input_image_path(image_path)
-    except Exception as e:
-        return image_path
+def fetch_media(media_data):
+    media_url = extract_media_url(media_data)
+    if not media_url:
+        return None
+    key = media_cache_key(media_data, media_url)
+    return media_cache.checkout(key, lambda: download_media(media_url))
+
+
+def build_text_overlay(fields):
+    return f"{fields.get('CHAR', '')}  {fields.get('SNAP', '')}"
 
 
+def run_image_job(*args):
+    """
+    Runs prepare_image in image_pool. A worker killed mid-job (the OOM
+    killer on a huge decode) breaks the whole pool, so replace it and
+    retry once.
+    """
+    global image_pool
+    pool = image_pool
+    try:
+        return pool.submit(prepare_image, *args).result()
+    except BrokenProcessPool as e:
+        with image_pool_lock:
+            if image_pool is pool:
+                logging.warning(f"Image worker pool broken, restarting it: {e}")
+                image_pool = new_image_pool()
+                pool.shutdown(wait=False)
+            pool = image_pool
+    return pool.submit(prepare_image, *args).result()
+
+
+def prepare_post_media(fields):
+    media_path = fetch_media(fields.get('IMG or Video'))
+    if media_path is None:
+        return None
+    text_overlay = None if fields.get('snap post title') else build_text_overlay(fields)
+    # resize, label and encode all run inside prepare_image in the worker process
+    with stage_timer('prepare_image') as stage:
+        prepared_path = run_image_job(media_path, text_overlay, UPLOAD_JPEG_QUALITY)
+        if prepared_path is None:
+            stage.fail()
+        return prepared_path
+
+
+def media_signature(fields):
+    media_data = fields.get('IMG or Video')
+    media_url = extract_media_url(media_data)
+    if not media_url:
+        return None
+    return media_cache_key(media_data, media_url), bool(fields.get('snap post title')), build_text_overlay(fields)
+
+
+class MediaPreparer:
+    """
+    Runs prepare_post_media on a small thread pool. Records are submitted
+    ahead of their post time by the scheduler; take() hands the dispatcher
+    the matching future, or starts preparation on the spot when nothing was
+    prefetched or the record's media changed since.
+    """
+
+    def __init__(self, max_workers=2, max_age=3600):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='media')
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.prepared = {}
+
+    def submit(self, record):
+        fields = record.get('fields', {})
+        signature = media_signature(fields)
+        if signature is None:
+            return None
+        now = time.time()
+        with self.lock:
+            for record_id in [rid for rid, entry in self.prepared.items() if now - entry[2] > self.max_age]:
+                self.prepared.pop(record_id)
+            entry = self.prepared.get(record['id'])
+            if entry and entry[0] == signature:
+                return entry[1]
+            future = self.executor.submit(prepare_post_media, fields)
+            self.prepared[record['id']] = (signature, future, now)
+        logging.info(f"Preparing media for record {record['id']}")
+        return future
+
+    def take(self, record):
+        future = self.submit(record)
+        with self.lock:
+            self.prepared.pop(record['id'], None)
+        return future
+
+
+@timed('login')
 def login(driver, account):
     random_delay(2,4)
     # driver.maximize_window()
@@ -217,18 +751,88 @@ def check_no_auth_needed(driver):
         return False
 
 
+SHADOW_WAIT_JS = """
+    const [paths, timeoutMs, clickable] = arguments;
+    const done = arguments[arguments.length - 1];
+
+    function resolve(path) {
+        let root = document;
+        let element = null;
+        for (let i = 0; i < path.length; i++) {
+            element = root.querySelector(path[i]);
+            if (!element) return null;
+            if (i < path.length - 1) {
+                root = element.shadowRoot;
+                if (!root) return null;
+            }
+        }
+        return element;
+    }
+
+    function ready(element) {
+        if (!element) return false;
+        if (!clickable) return true;
+        return !element.disabled
+            && element.getAttribute('aria-disabled') !== 'true'
+            && element.getClientRects().length > 0;
+    }
+
+    function check() {
+        for (const [name, path] of Object.entries(paths)) {
+            const element = resolve(path);
+            if (ready(element)) return [name, element];
+        }
+        return null;
+    }
+
+    let finished = false;
+    let observer = null;
+    let timer = null;
+    let deadline = null;
+    function finish(result) {
+        if (finished) return;
+        finished = true;
+        if (observer) observer.disconnect();
+        clearInterval(timer);
+        clearTimeout(deadline);
+        done(result);
+    }
+
+    const result = check();
+    if (result) return finish(result);
+    // Mutations inside shadow roots do not reach a document observer, so
+    // a short interval backs it up.
+    observer = new MutationObserver(() => { const r = check(); if (r) finish(r); });
+    observer.observe(document, {subtree: true, childList: true, attributes: true});
+    timer = setInterval(() => { const r = check(); if (r) finish(r); }, 100);
+    deadline = setTimeout(() => finish(null), timeoutMs);
+"""
+
+
+def wait_for_shadow_any(driver, paths, timeout=20, clickable=False):
+    """
+    Waits in the page for the first of several shadow DOM paths to resolve.
+    paths maps a name to a list of selectors, one per shadow root level,
+    e.g. {"title": ["faceplate-textarea-input", "textarea#innerTextArea"]}.
+    Costs a single WebDriver round trip. Returns (name, element), or
+    (None, None) on timeout.
+    """
+    if getattr(driver, 'shadow_script_timeout', 0) < timeout + 5:
+        driver.set_script_timeout(timeout + 5)
+        driver.shadow_script_timeout = timeout + 5
+    result = driver.execute_async_script(SHADOW_WAIT_JS, paths, int(timeout * 1000), clickable)
+    if not result:
+        return None, None
+    return result[0], result[1]
+
+
+def wait_for_shadow(driver, path, timeout=20, clickable=False):
+    return wait_for_shadow_any(driver, {'element': path}, timeout, clickable)[1]
+
+
 def get_shadow_element(driver, host_selector, element_selector):
     try:
-        shadow_host = WebDriverWait(driver, 40).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, host_selector))
-        )
-        shadow_root = driver.execute_script('return arguments[0].shadowRoot', shadow_host)
-        if shadow_root is None:
-            return None
-        return shadow_root.find_element(By.CSS_SELECTOR, element_selector)
-
-    except NoSuchElementException:
-        return None
+        return wait_for_shadow(driver, [host_selector, element_selector], 40)
     except Exception as e:
         return None
 
@@ -255,7 +859,7 @@ def add_content_to_post(driver, content):
             EC.presence_of_element_located((By.CSS_SELECTOR, "div[contenteditable='true'][aria-label='Post body text field']"))
         )
         content_element.click()
-        time.sleep(1)
+        pacing.pause()
 
         driver.execute_script("""
             arguments[0].focus();
@@ -273,17 +877,10 @@ def add_content_to_post(driver, content):
 
 def add_title_to_post(driver, title, snap_value, char_value):
     try:
-        shadow_host = WebDriverWait(driver, 20).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "faceplate-textarea-input"))
-        )
-        shadow_root = driver.execute_script('return arguments[0].shadowRoot', shadow_host)
-        if shadow_root is None:
+        title_input = wait_for_shadow(driver, ["faceplate-textarea-input", "textarea#innerTextArea"], 20)
+        if title_input is None:
             return False
 
-        title_input = WebDriverWait(shadow_root, 20).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "textarea#innerTextArea"))
-        )
-
         full_title = f"{title} {char_value} {snap_value}".strip()
 
         filtered_title = filter_bmp_characters(full_title)
@@ -318,88 +915,56 @@ def start_session(self, ads_id):
 
 def input_flair(driver, flair):
     try:
-        shadow_host = WebDriverWait(driver, 20).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "r-post-flairs-modal"))
-        )
-        shadow_root = driver.execute_script('return arguments[0].shadowRoot', shadow_host)
-        if shadow_root is None:
-            return False
-
-        search_input_host = shadow_root.find_element(By.CSS_SELECTOR, "faceplate-search-input")
-        search_input_root = driver.execute_script('return arguments[0].shadowRoot', search_input_host)
-        if search_input_root is None:
+        input_filter = wait_for_shadow(driver, ["r-post-flairs-modal", "faceplate-search-input", "input"], 20)
+        if input_filter is None:
             return False
-
-        all_elements = search_input_root.find_elements(By.CSS_SELECTOR, "*")
-
-        try:
-            input_filter = search_input_root.find_element(By.CSS_SELECTOR, "input")
-            input_filter.clear()
-            input_filter.send_keys(flair)
-            return True
-        except NoSuchElementException:
-            return False
-
-    except TimeoutException:
-        return False
+        input_filter.clear()
+        input_filter.send_keys(flair)
+        return True
     except Exception as e:
         return False
 
 
-
 def select_flair(driver, flair):
     try:
-        shadow_host = WebDriverWait(driver, 20).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "r-post-flairs-modal"))
-        )
-        shadow_root = driver.execute_script('return arguments[0].shadowRoot', shadow_host)
-        if shadow_root is None:
-            return False
-
-        add_flair_button = WebDriverWait(shadow_root, 20).until(
-            EC.element_to_be_clickable((By.ID, "reddit-post-flair-button"))
-        )
+        add_flair_button = wait_for_shadow(driver, ["r-post-flairs-modal", "#reddit-post-flair-button"],
+                                           STEP_TIMEOUT, clickable=True)
+        if add_flair_button is None:
+            raise TimeoutException("Flair button not found")
         driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", add_flair_button)
 
         add_flair_button.click()
-        shadow_host = WebDriverWait(driver, 40).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "r-post-flairs-modal"))
-        )
-        shadow_root = driver.execute_script('return arguments[0].shadowRoot', shadow_host)
-        if shadow_root is None:
-            return False
-        time.sleep(3)
-
-        flair_radio_button = WebDriverWait(shadow_root, 40).until(
-            EC.element_to_be_clickable((By.ID, "post-flair-radio-input-0"))
-        )
+        flair_radio_button = wait_for_shadow(driver, ["r-post-flairs-modal", "#post-flair-radio-input-0"],
+                                             40, clickable=True)
+        if flair_radio_button is None:
+            raise TimeoutException("Flair options not found")
 
 
         input_flair(driver, flair)
-        time.sleep(1)
+        pacing.pause()
         flair_radio_button.click()
-        add_button = WebDriverWait(shadow_root, 40).until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, "button#post-flair-modal-apply-button"))
-        )
+        add_button = wait_for_shadow(driver, ["r-post-flairs-modal", "button#post-flair-modal-apply-button"],
+                                     40, clickable=True)
+        if add_button is None:
+            raise TimeoutException("Flair apply button not found")
         add_button.click()
-        random_delay()
+        wait_for_script(driver, FLAIR_MODAL_CLOSED_JS, STEP_TIMEOUT)
+        pacing.pause()
         return True
     except TimeoutException:
         close_flair = get_shadow_element(driver, "r-post-flairs-modal", "button.button-small.button-secondary.icon.items-center.justify-center")
         close_flair.click()
-        time.sleep(3)
+        wait_for_script(driver, FLAIR_MODAL_CLOSED_JS, STEP_TIMEOUT)
         post_button = WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.ID, "submit-post-button"))
+            EC.element_to_be_clickable((By.ID, "submit-post-button"))
         )
-        time.sleep(1)
+        pacing.pause()
         post_button.click()
         return False
     except Exception as e:
         return False
 
 
-
-
 def click_element_with_retry(driver, element, max_retries=3, scroll=True):
     retries = 0
     while retries < max_retries:
@@ -417,14 +982,14 @@ def click_element_with_retry(driver, element, max_retries=3, scroll=True):
 
 def click_post_button_directly(driver):
     try:
-        random_delay(3,5)
+        pacing.pause()
         driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        post_button = WebDriverWait(driver, 20).until(
+        post_button = WebDriverWait(driver, STEP_TIMEOUT).until(
             EC.presence_of_element_located((By.ID, "submit-post-button"))
         )
         driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", post_button)
-        WebDriverWait(driver, 10).until(EC.element_to_be_clickable(post_button))
-        time.sleep(10)
+        WebDriverWait(driver, STEP_TIMEOUT).until(EC.element_to_be_clickable(post_button))
+        pacing.pause()
         post_button.click()
         return True
     except TimeoutException:
@@ -438,6 +1003,52 @@ def random_delay(min_seconds=5, max_seconds=10):
     time.sleep(delay)
 
 
+class PacingPolicy:
+    """
+    Short randomized pause between composer actions. The real waiting is
+    done by explicit readiness conditions; this only keeps actions from
+    firing back to back.
+    """
+
+    def __init__(self, min_delay=0.5, max_delay=1.5):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    def pause(self, scale=1.0):
+        time.sleep(random.uniform(self.min_delay, self.max_delay) * scale)
+
+
+pacing = PacingPolicy(PACING_MIN_DELAY, PACING_MAX_DELAY)
+
+UPLOAD_COMPLETE_JS = """
+    const host = document.querySelector('r-post-media-input');
+    const root = host && host.shadowRoot;
+    if (!root) return false;
+    if (root.querySelector('[role="progressbar"], faceplate-progress, [uploading]')) return false;
+    // the submit button alone proves nothing: the title already enables it before the file is sent
+    const previews = [...root.querySelectorAll('img, video'), ...host.querySelectorAll('img, video')];
+    return previews.some(el => el.tagName === 'VIDEO' || (el.complete && el.naturalWidth > 0));
+"""
+
+FLAIR_MODAL_CLOSED_JS = """
+    const host = document.querySelector('r-post-flairs-modal');
+    if (!host || !host.shadowRoot) return true;
+    const button = host.shadowRoot.querySelector('#post-flair-modal-apply-button');
+    return !button || button.offsetParent === null;
+"""
+
+
+def wait_for_script(driver, script, timeout, poll_frequency=0.25):
+    """Waits until script returns a truthy value; returns False on timeout."""
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=poll_frequency).until(
+            lambda d: d.execute_script(script)
+        )
+        return True
+    except TimeoutException:
+        return False
+
+
 def on_cupid(driver):
     try:
         checkbox = WebDriverWait(driver, 10).until(
@@ -471,89 +1082,113 @@ def off_cupid(driver):
         logging.error(f"Error toggling Cupid switch: {e}")
 
 
-def post_to_reddit(driver, flair, title, content, media_path=None, subreddit_name="test", snap_value='', char_value=''):
+def post_to_reddit(driver, flair, title, content, media_path=None, subreddit_name="test", snap_value='', char_value='',
+                   outcome=None):
     # off_cupid(driver)
+    outcome = outcome or PostOutcome()
     try:
+        outcome.stage = 'open_subreddit'
         subreddit_url = f"https://www.reddit.com/r/{subreddit_name}/"
         driver.get(subreddit_url)
 
-        create_post_button = WebDriverWait(driver, 20).until(
+        create_post_button = WebDriverWait(driver, STEP_TIMEOUT).until(
             EC.element_to_be_clickable((By.XPATH, "//span[contains(text(), 'Create Post')]"))
         )
+        outcome.stage = 'create_post'
         create_post_button.click()
-        random_delay()
+        WebDriverWait(driver, STEP_TIMEOUT).until(
+            EC.presence_of_element_located((By.CSS_SELECTOR, "faceplate-textarea-input"))
+        )
+        pacing.pause()
         if not content and not media_path:
+            outcome.stage = 'title'
             add_title_to_post(driver, title, snap_value, char_value)
-            random_delay(2,5)
+            pacing.pause()
+            outcome.stage = 'submit'
             post_button = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, "submit-post-button"))
+                EC.element_to_be_clickable((By.ID, "submit-post-button"))
             )
-            time.sleep(2)
             post_button.click()
-            random_delay(3,5)
+            pacing.pause()
+            outcome.stage = 'flair'
             select_flair(driver, flair)
-            random_delay(2, 5)
+            pacing.pause()
+            outcome.stage = 'submit'
             post_button1 = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, "submit-post-button"))
+                EC.element_to_be_clickable((By.ID, "submit-post-button"))
             )
             post_button1.click()
 
         if content:
+            outcome.stage = 'title'
             add_title_to_post(driver, title, snap_value, char_value)
-            random_delay(2,5)
+            pacing.pause()
+            outcome.stage = 'content'
             add_content_to_post(driver, content)
-            random_delay(2,5)
+            pacing.pause()
+            outcome.stage = 'submit'
             driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
             post_button = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, "submit-post-button"))
+                EC.element_to_be_clickable((By.ID, "submit-post-button"))
             )
-            time.sleep(5)
+            pacing.pause()
             post_button.click()
-            random_delay(4,7)
+            pacing.pause()
+            outcome.stage = 'flair'
             select_flair(driver, flair)
-            random_delay(4,7)
+            pacing.pause()
+            outcome.stage = 'submit'
             post_button1 = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, "submit-post-button"))
+                EC.element_to_be_clickable((By.ID, "submit-post-button"))
             )
             post_button1.click()
-            random_delay(4,7)
+            pacing.pause()
 
         else:
             image_button = get_shadow_element(driver, 'r-post-type-select', 'button[data-select-value="IMAGE"]')
             if image_button and media_path and image_button.is_enabled():
                 image_button.click()
-                random_delay(5, 10)
+                pacing.pause()
 
+                outcome.stage = 'title'
                 if not add_title_to_post(driver, title, snap_value, char_value):
                     return False
 
-                random_delay(5, 10)
+                pacing.pause()
+                outcome.stage = 'upload'
                 upload_button = get_shadow_element(driver, "r-post-media-input", "input[type='file']")
                 if upload_button:
                     upload_button.send_keys(media_path)
-                    time.sleep(30)
+                    if not wait_for_script(driver, UPLOAD_COMPLETE_JS, UPLOAD_TIMEOUT, poll_frequency=0.5):
+                        logging.error(f"Upload did not finish within {UPLOAD_TIMEOUT}s: {media_path}")
+                        return False
                 else:
                     return False
 
             else:
+                outcome.stage = 'title'
                 if not add_title_to_post(driver, title, snap_value, char_value):
                     return False
+            outcome.stage = 'submit'
             if not click_post_button_directly(driver):
                 return False
-            time.sleep(2)
+            outcome.stage = 'flair'
             if not select_flair(driver, flair):
                 return False
 
-            random_delay(3, 5)
+            pacing.pause()
 
+            outcome.stage = 'submit'
             if not click_post_button_directly(driver):
                 return False
 
-            WebDriverWait(driver, 20).until(
-                EC.presence_of_element_located(
-                    (By.XPATH, "//a[contains(@href, '/r/') and contains(@href, '/comments/')]"))
-            )
-            return True
+        outcome.stage = 'confirm'
+        post_link = WebDriverWait(driver, STEP_TIMEOUT).until(
+            EC.presence_of_element_located(
+                (By.XPATH, "//a[contains(@href, '/r/') and contains(@href, '/comments/')]"))
+        )
+        outcome.permalink = post_link.get_attribute('href')
+        return True
 
     except TimeoutException as te:
         return False
@@ -579,15 +1214,18 @@ def extract_media_url(media_data):
 local_tz = pytz.timezone("Europe/London")
 post_time = datetime(2024, 12, 10, 14, 30, tzinfo=local_tz)
 
+def localize_post_time(post_time, timezone_name="Europe/London"):
+    local_tz = pytz.timezone(timezone_name)
+    if post_time.tzinfo is None:
+        return local_tz.localize(post_time)
+    return post_time.astimezone(local_tz)
+
+
 def should_post_now(post_time, timezone_name="Europe/London"):
     try:
         local_tz = pytz.timezone(timezone_name)
         now = datetime.now(local_tz).replace(second=0, microsecond=0)
-
-        if post_time.tzinfo is None:
-            post_time = local_tz.localize(post_time)
-        else:
-            post_time = post_time.astimezone(local_tz)
+        post_time = localize_post_time(post_time, timezone_name)
 
         time_difference = abs((post_time - now).total_seconds())
         return time_difference <= 40
@@ -595,15 +1233,146 @@ def should_post_now(post_time, timezone_name="Europe/London"):
         return False
 
 
-def clear_temp_folder(folder_path='temp'):
+class PostScheduler:
+    """
+    Min-heap of scheduled records keyed on their post time. The run loop
+    sleeps until the earliest entry is due, so inserts and updates cost
+    O(log n) and nothing is rescanned while waiting. Superseded heap items
+    are skipped lazily when they reach the top.
+
+    With a prefetch callback, every record also gets a second heap item
+    prefetch_lead seconds before its post time, so media can be prepared
+    before the record is dispatched.
+    """
+
+    def __init__(self, dispatch, timezone_name="Europe/London", late_grace=120, prefetch=None, prefetch_lead=0):
+        self.dispatch = dispatch
+        self.timezone_name = timezone_name
+        self.late_grace = late_grace
+        self.prefetch = prefetch
+        self.prefetch_lead = prefetch_lead
+        self.heap = []
+        self.entries = {}
+        self.dispatched = {}
+        self.prefetch_pending = set()
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def get_post_time(self, fields):
+        post_date = fields.get('Date')
+        post_time_str = fields.get('Time')
+        if not post_date or not post_time_str:
+            return None
+        try:
+            post_time = parse_datetime(post_date, post_time_str)
+            if post_time is None:
+                return None
+            return localize_post_time(post_time, self.timezone_name)
+        except Exception as e:
+            logging.error(f"Invalid post time {post_date!r} {post_time_str!r}: {e}")
+            return None
+
+    def push(self, fire_at, seq, record_id):
+        heapq.heappush(self.heap, (fire_at, seq, 'post', record_id))
+        if self.prefetch and seq in self.prefetch_pending:
+            heapq.heappush(self.heap, (fire_at - self.prefetch_lead, seq, 'prefetch', record_id))
+
+    def schedule(self, record):
+        record_id = record['id']
+        fields = record['fields']
+        post_time = self.get_post_time(fields) if fields.get('Scheduled?') else None
+        if post_time is None:
+            self.cancel(record_id)
+            return
+
+        fire_at = post_time.timestamp()
+        with self.condition:
+            if self.dispatched.get(record_id) == fire_at:
+                return
+            self.dispatched.pop(record_id, None)
+            entry = self.entries.get(record_id)
+            if entry and entry[0] == fire_at:
+                self.entries[record_id] = (fire_at, entry[1], record)
+                return
+            if entry:
+                self.prefetch_pending.discard(entry[1])
+            seq = next(self.counter)
+            self.entries[record_id] = (fire_at, seq, record)
+            if self.prefetch:
+                self.prefetch_pending.add(seq)
+            self.push(fire_at, seq, record_id)
+            if len(self.heap) > 4 * len(self.entries) + 64:
+                self.heap = []
+                for rid, (entry_fire_at, entry_seq, _) in self.entries.items():
+                    self.push(entry_fire_at, entry_seq, rid)
+            if self.heap[0][1] == seq:
+                self.condition.notify()
+
+    def cancel(self, record_id):
+        with self.condition:
+            entry = self.entries.pop(record_id, None)
+            if entry:
+                self.prefetch_pending.discard(entry[1])
+            self.dispatched.pop(record_id, None)
+
+    def is_stale(self, item):
+        entry = self.entries.get(item[3])
+        return entry is None or entry[1] != item[1]
+
+    def next_due(self):
+        with self.condition:
+            while True:
+                while self.heap and self.is_stale(self.heap[0]):
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                wake_at, seq, kind, record_id = self.heap[0]
+                delay = wake_at - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+                self.prefetch_pending.discard(seq)
+                if kind == 'prefetch':
+                    fire_at, _, record = self.entries[record_id]
+                else:
+                    fire_at, _, record = self.entries.pop(record_id)
+                    self.dispatched[record_id] = fire_at
+                return kind, record, fire_at
+
+    def run(self):
+        while True:
+            kind, record, fire_at = self.next_due()
+            late = time.time() - fire_at
+            if late > self.late_grace:
+                if kind == 'post':
+                    logging.warning(f"Skip record {record['id']}: post time passed {int(late)}s ago")
+                continue
+            try:
+                if kind == 'prefetch':
+                    self.prefetch(record)
+                else:
+                    self.dispatch(record)
+            except Exception as e:
+                logging.error(f"Error dispatching record {record['id']}: {e}")
+
+
+def clear_temp_folder(folder_path='temp', max_age=None, remove_dirs=False):
     try:
         if not os.path.exists(folder_path):
             return
+        now = time.time()
         for filename in os.listdir(folder_path):
             file_path = os.path.join(folder_path, filename)
             try:
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
+                if os.path.isfile(file_path) or (remove_dirs and os.path.isdir(file_path)):
+                    if max_age is not None and now - os.path.getmtime(file_path) < max_age:
+                        continue
+                    if os.path.isdir(file_path):
+                        shutil.rmtree(file_path)
+                    else:
+                        os.remove(file_path)
 
             except Exception as e:
                 logging.error(f" {file_path}: {e}")
@@ -613,84 +1382,85 @@ def clear_temp_folder(folder_path='temp'):
 
 def schedule_daily_cleanup():
     while True:
-        current_time = datetime.now().strftime("%H:%M")
-        if current_time == "00:00":
-            clear_temp_folder('temp')
-            time.sleep(86400)
-        time.sleep(60)
+        time.sleep(3600)
+        clear_temp_folder('temp', max_age=TEMP_MAX_AGE)
+        clear_temp_folder(PREPARED_FOLDER, max_age=TEMP_MAX_AGE, remove_dirs=True)
+        media_cache.evict()
+        logging.info(f"Media cache: {media_cache.stats()}")
+
+
+def merge_records(new_records, full=False):
+    global RECORDS
+    with RECORDS_LOCK:
+        index = {} if full else RECORDS
+        for record in new_records:
+            record_id = record['id']
+            fields = record['fields']
+            if fields.get('Scheduled?', False):
+                index[record_id] = record
+            else:
+                index.pop(record_id, None)
+            post_scheduler.schedule(record)
+        if full:
+            for record_id in RECORDS.keys() - index.keys():
+                post_scheduler.cancel(record_id)
+        RECORDS = index
 
 
 def add_posts_to_cache():
-    global RECORDS, POSTS_ON_WORK
+    last_sync = None
+    last_full_sync = 0
     while True:
-        new_records = get_data_from_airtable()
-        if new_records != RECORDS:
-            RECORDS = new_records
-            for record in RECORDS:
-                record_id = record['id']
-                fields = record['fields']
-                if fields.get('Scheduled?', False) and record_id in POSTS_ON_WORK:
-                    POSTS_ON_WORK.remove(record_id)
-
-        time.sleep(20)
-
-
+        started = datetime.now(pytz.utc)
+        full = last_sync is None or time.time() - last_full_sync >= AIRTABLE_FULL_SYNC_INTERVAL
+        since = None if full else last_sync - timedelta(seconds=AIRTABLE_SYNC_OVERLAP)
+        new_records = get_data_from_airtable(since)
+        if new_records is not None:
+            merge_records(new_records, full=full)
+            last_sync = started
+            if full:
+                last_full_sync = time.time()
+        elif not full:
+            # e.g. AIRTABLE_MODIFIED_FIELD missing from the table: don't wait for the next full sync
+            logging.warning("Incremental Airtable sync failed, doing a full sync next cycle")
+            last_sync = None
+
+        time.sleep(AIRTABLE_SYNC_INTERVAL)
+
+
+@timed('screen_error', falsy_is_failure=True)
 def screen_error(driver, account_name, subreddit_name, post_time,):
     try:
         driver.execute_script("window.scrollTo(0, 0);")
 
-        time.sleep(1)
-
         create_post_button = WebDriverWait(driver, 40).until(
             EC.element_to_be_clickable((By.XPATH, "//span[contains(text(), 'Create Post')]"))
         )
-        time.sleep(15)
         return create_post_button
     except TimeoutException:
         take_screenshot(driver, account_name, subreddit_name, post_time)
         return None
 
 
-def check_records():
-    global RECORDS, POSTS_ON_WORK
-
-    while True:
-        for record in RECORDS:
-            try:
-                record_id = record['id']
-
-                if record_id in POSTS_ON_WORK:
-                    continue
-
-                fields = record['fields']
+def dispatch_record(record):
+    post_cache.put(record)
+    airtable_writer.update(record['id'], {'Scheduled?': False})
 
-                post_date = fields.get('Date')
-                post_time_str = fields.get('Time')
 
+media_preparer = MediaPreparer(MEDIA_WORKERS, PREFETCH_LEAD + POST_LATE_GRACE + 600)
+post_scheduler = PostScheduler(dispatch_record, POST_TIMEZONE, POST_LATE_GRACE,
+                               prefetch=media_preparer.submit, prefetch_lead=PREFETCH_LEAD)
 
-                if not post_date:
-                    continue
-
-                if not post_time_str:
-                    continue
-                post_time = parse_datetime(post_date, post_time_str)
-
-                if post_time is None:
-                    continue
-                if fields.get('Scheduled?') and should_post_now(post_time):
-                    post_cache.put(record)
-                    POSTS_ON_WORK.append(record_id)
-                    table.update(record_id, {'Scheduled?': False})
-
-            except TypeError as e:
-                logging.error(f"TypeError encountered: {e}")
-                logging.error(f"Record that caused error: {record}")
-
-            except Exception as e:
-                logging.error(f"Unexpected error: {e}")
-
-        time.sleep(10)
-
+REGISTRY.gauge('reddit_poster_scheduled_posts', 'Posts waiting for their time in the scheduler',
+               function=lambda: len(post_scheduler.entries))
+REGISTRY.gauge('reddit_poster_dispatch_queue_depth', 'Due posts waiting to be submitted', function=post_cache.qsize)
+REGISTRY.gauge('reddit_poster_posting_jobs', 'Posting jobs running or queued', function=posting_executor.pending)
+REGISTRY.gauge('reddit_poster_active_browsers', 'Browsers in use by a posting job',
+               function=lambda: session_manager.browsers_in_use)
+REGISTRY.gauge('reddit_poster_idle_browsers', 'Warm browsers kept open for reuse',
+               function=lambda: len(session_manager.idle))
+REGISTRY.gauge('reddit_poster_airtable_pending_writes', 'Records with Airtable updates waiting to flush',
+               function=lambda: len(airtable_writer.pending))
 
 
 def parse_datetime(date_str, time_str):
@@ -711,148 +1481,169 @@ def parse_datetime(date_str, time_str):
         return None
 
 
+screenshot_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='screenshot')
+
+
+def capture_screenshot(driver, mode='viewport'):
+    """
+    Returns a base64 JPEG of the page without resizing the window. 'full'
+    clips to the document size (capped at SCREENSHOT_MAX_HEIGHT) and
+    captures beyond the viewport; 'viewport' takes what is on screen.
+    """
+    params = {'format': 'jpeg', 'quality': SCREENSHOT_QUALITY}
+    try:
+        if mode == 'full':
+            metrics = driver.execute_cdp_cmd('Page.getLayoutMetrics', {})
+            content = metrics.get('cssContentSize') or metrics['contentSize']
+            params['captureBeyondViewport'] = True
+            params['clip'] = {
+                'x': 0,
+                'y': 0,
+                'width': content['width'],
+                'height': min(content['height'], SCREENSHOT_MAX_HEIGHT),
+                'scale': 1,
+            }
+        return driver.execute_cdp_cmd('Page.captureScreenshot', params)['data']
+    except AttributeError:
+        # not a Chromium driver, no CDP
+        return driver.get_screenshot_as_base64()
+
+
+def write_screenshot(data, filename, account_name, timestamp):
+    try:
+        with open(filename, 'wb') as f:
+            f.write(base64.b64decode(data))
+        logging.error(f"Screenshot {account_name} in time {timestamp}: {filename}")
+    except Exception as e:
+        logging.error(f"Error saving screenshot {filename}: {e}")
+
+
 def take_screenshot(driver, account_name, subreddit_name, post_time):
     local_tz = pytz.timezone("Europe/Kiev")
     local_time = post_time.astimezone(local_tz)
     timestamp = local_time.strftime("%I-%M%p")
 
-    folder_path = f"errors/{account_name}/"
-    os.makedirs(folder_path, exist_ok=True)
     today = datetime.now().strftime("%d_%m")
-    filename = f"{folder_path}/{today}/{subreddit_name}_{timestamp}.png"
+    folder_path = f"errors/{account_name}/{today}"
+    os.makedirs(folder_path, exist_ok=True)
+    filename = f"{folder_path}/{subreddit_name}_{timestamp}.jpg"
     try:
-        total_width = driver.execute_script("return document.body.scrollWidth")
-        total_height = driver.execute_script("return document.body.scrollHeight")
+        data = capture_screenshot(driver, SCREENSHOT_MODE)
+        screenshot_writer.submit(write_screenshot, data, filename, account_name, timestamp)
 
-        driver.set_window_size(total_width, total_height)
+    except Exception as e:
+        logging.error(f" {account_name}: {e}")
 
-        driver.execute_script("window.scrollTo(0, 0);")
-        driver.execute_script(f"window.scrollTo(0, {total_height // 2});")
 
 
-        driver.save_screenshot(filename)
-        logging.error(f"Screenshot {account_name} in time {timestamp}: {filename}")
+def dispatch_post(record):
+    record_id = record['id']
+    fields = record.get('fields', {})
 
-    except Exception as e:
-        logging.error(f" {account_name}: {e}")
+    flair = fields.get('Flair', '')
+    title = fields.get('Title', 'No title')
+    content = fields.get('Text', '')
+    subreddit_name = fields.get('Subreddit', 'test')
+    account_name = fields.get('Account', None)
 
+    post_date = fields.get('Date')
+    post_time_str = fields.get('Time')
 
+    if not post_date or not post_time_str:
+        return
+    post_time = parse_datetime(post_date, post_time_str)
+    if post_time is None:
+        return
+    if isinstance(account_name, list):
+        account_name = account_name[0]
+    if not account_name:
+        return
 
-def process_post_cache_selenium():
-    while True:
-        try:
-            if not post_cache.empty():
-                record = post_cache.get()
-                record_id = record['id']
-                fields = record.get('fields', {})
-
-                flair = fields.get('Flair', '')
-                char_value = fields.get('CHAR', '')
-                snap_value = fields.get('SNAP', '')
-                title = fields.get('Title', 'No title')
-                content = fields.get('Text', '')
-                subreddit_name = fields.get('Subreddit', 'test')
-                account_name = fields.get('Account', None)
-
-                post_date = fields.get('Date')
-                post_time_str = fields.get('Time')
-
-                if post_date and post_time_str:
-                    post_time = parse_datetime(post_date, post_time_str)
-                    if post_time is None:
-                        post_cache.task_done()
-                        continue
-                else:
-                    post_cache.task_done()
-                    continue
-                if isinstance(account_name, list):
-                    account_name = account_name[0]
-                if not account_name:
-                    post_cache.task_done()
-                    continue
+    profile_serial_number, password = get_ads_account_data(account_name)
 
-                profile_serial_number, password = get_ads_account_data(account_name)
+    if not profile_serial_number:
+        return
 
-                if not profile_serial_number:
-                    post_cache.task_done()
-                    continue
+    has_media = bool(fields.get('IMG or Video'))
+    media_future = media_preparer.take(record) if has_media else None
+    text_overlay = build_text_overlay(fields)
+    if media_future is not None and not fields.get('snap post title'):
+        text_overlay = ''
+    try:
+        posting_executor.submit(record_id, run_posting_job, record_id, has_media, media_future,
+                                account_name, post_time, profile_serial_number, flair, subreddit_name, title,
+                                content, account_name, password, text_overlay, key=profile_serial_number)
+    except Exception as e:
+        logging.error(f"Error processing post for record {record_id}: {e}")
 
-                media_data = fields.get('IMG or Video', None)
-                media_path = None
-                try:
-                    if not media_data:
-                        text_overlay = f"{char_value}  {snap_value}"
-                        threading.Thread(
-                            target=try_posting_to_reddit_selenium,
-                            args=(account_name, post_time, profile_serial_number, flair, subreddit_name, title, content,
-                                  media_path, account_name, password, text_overlay),
-                            daemon=True
-                        ).start()
 
-                    else:
-                        media_url = extract_media_url(media_data)
-                        media_path = download_media(media_url)
-                        text_overlay = f"{char_value}  {snap_value}"
-                        if fields.get('snap post title'):
-                            media_path = process_image(media_path)
-                            threading.Thread(
-                                target=try_posting_to_reddit_selenium,
-                                args=(account_name, post_time, profile_serial_number, flair, subreddit_name, title, content,
-                                      media_path, account_name, password, text_overlay),
-                                daemon=True
-                            ).start()
-                            time.sleep(5)
-                        else:
-                            media_path = process_image(media_path)
-                            media_path = add_text_with_rounded_background(text_overlay, media_path)
-                            threading.Thread(
-                                target=try_posting_to_reddit_selenium,
-                                args=(account_name, post_time, profile_serial_number, flair, subreddit_name, title, content,
-                                      media_path, account_name, password),
-                                daemon=True
-                            ).start()
-
-
-                except Exception as e:
-                    logging.error(f"Error processing post for record {record_id}: {e}")
-
-                finally:
-                    pass
-
-
-                time.sleep(random.uniform(10, 20))
-            else:
-                time.sleep(5)
+def run_posting_job(record_id, has_media, media_future, account_name, post_time, ads_id, flair, subreddit_name,
+                    title, content, username=None, password=None, snap_value=''):
+    with log_context(job_id=record_id, ads_id=ads_id):
+        outcome = PostOutcome()
+        media_path = None
+        if has_media:
+            outcome.stage = 'media'
+            try:
+                media_path = media_future.result() if media_future is not None else None
+            except Exception as e:
+                logging.error(f"Error preparing media for {subreddit_name}: {e}")
+        if has_media and media_path is None:
+            # posting anyway would submit a title-only post and record it as a success
+            success = False
+        else:
+            success = try_posting_to_reddit_selenium(account_name, post_time, ads_id, flair, subreddit_name, title,
+                                                     content, media_path, username, password, snap_value,
+                                                     outcome=outcome)
+        outcome.finish(success)
+        if not outcome.success:
+            logging.error(f"Post {record_id} to r/{subreddit_name} failed at stage '{outcome.stage}'")
+        airtable_writer.update(record_id, outcome.fields(), group='outcome')
+        return outcome
+
+
+def process_post_cache_selenium():
+    while True:
+        try:
+            record = post_cache.get(timeout=DISPATCH_POLL_TIMEOUT)
+        except queue.Empty:
+            continue
 
+        try:
+            dispatch_post(record)
         except TypeError as e:
             logging.error(f"TypeError in processing record: {e}")
-            time.sleep(2)
-
         except Exception as e:
             logging.error(f"Error in processing post: {e}")
-            time.sleep(2)
-
+        finally:
+            post_cache.task_done()
 
 
 def try_posting_to_reddit_selenium(account_name, post_time, ads_id, flair, subreddit_name, title, content, media_path=None, username=None,
-                                   password=None, snap_value='', char_value=''):
-    while session_manager.is_session_active(ads_id):
-        time.sleep(2)
-
-    account_close_config = next((account[4] for account in ads_accounts_config if account[0] == account_name), "True")
-    close_browser = str(account_close_config).lower() == "true"
+                                   password=None, snap_value='', char_value='', outcome=None):
+    outcome = outcome or PostOutcome()
+    ads_account = registry.account(account_name)
+    close_browser = ads_account.close if ads_account is not None else True
+    driver = None
+    success = False
     try:
-        driver = session_manager.start_session(ads_id)
+        outcome.stage = 'browser'
+        driver, warm = session_manager.start_session(ads_id)
         if driver is None:
             logging.error(f" AdsPower ID: {ads_id}")
-            return None
+            return False
 
+        outcome.stage = 'login'
         account = Account(username, password)
-        login(driver, account)
-        time.sleep(2)
+        if warm:
+            close_extra_tabs(driver)
+        if not warm or not is_logged_in(driver):
+            login(driver, account)
+            time.sleep(2)
 
         try:
-            success = post_to_reddit(driver, flair, title, content, media_path, subreddit_name, snap_value, char_value)
+            success = post_to_reddit(driver, flair, title, content, media_path, subreddit_name, snap_value, char_value,
+                                     outcome)
         except UnexpectedAlertPresentException:
             alert = Alert(driver)
             logging.error(f"Unexpected alert open: {alert.text}")
@@ -868,20 +1659,17 @@ def try_posting_to_reddit_selenium(account_name, post_time, ads_id, flair, subre
     except Exception as e:
         logging.error(f"Error: {e}")
     finally:
-        if close_browser:
-            if driver:
-                close_driver(ads_id)
-            session_manager.end_session(ads_id)
-        else:
-            driver.quit()
-            session_manager.end_session(ads_id)
+        if driver:
             # on_cupid(driver)
-            logging.info(f"Wait {account_name}.")
+            session_manager.release(ads_id, driver, close_browser)
+    return success
 
 if __name__ == '__main__':
     if not os.path.exists("temp"):
         os.mkdir("temp")
     for f in os.listdir("temp/"):
+        if f == "cache":
+            continue
         try:
             shutil.rmtree(os.path.join("temp/", f))
         except Exception:
@@ -890,6 +1678,9 @@ if __name__ == '__main__':
             except Exception as e:
                 pass
     threading.Thread(target=add_posts_to_cache, daemon=True).start()
-    threading.Thread(target=check_records, daemon=True).start()
+    threading.Thread(target=post_scheduler.run, daemon=True).start()
     threading.Thread(target=schedule_daily_cleanup, daemon=True).start()
+    threading.Thread(target=session_manager.run_reaper, daemon=True).start()
+    threading.Thread(target=airtable_writer.run, daemon=True).start()
+    start_metrics_server(METRICS_PORT)
     process_post_cache_selenium()
@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+
+def media_cache_key(media_data, media_url):
+    """Airtable attachment id when available, otherwise a hash of the url."""
+    if isinstance(media_data, list) and media_data:
+        media_data = media_data[0]
+    if isinstance(media_data, dict) and media_data.get('id'):
+        return str(media_data['id'])
+    return hashlib.sha1(media_url.encode('utf-8')).hexdigest()
+
+
+class MediaCache:
+    """
+    On-disk cache holding one copy of each downloaded attachment. Entries
+    are evicted least recently used first once the folder grows past
+    max_bytes. Callers get a private working copy from checkout(), since
+    the image pipeline rewrites its input file in place.
+    """
+
+    def __init__(self, folder='temp/cache', max_bytes=2 * 1024 ** 3):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.load_index()
+
+    def load_index(self):
+        os.makedirs(self.folder, exist_ok=True)
+        files = []
+        for filename in os.listdir(self.folder):
+            path = os.path.join(self.folder, filename)
+            if os.path.isfile(path):
+                files.append((os.path.getmtime(path), filename, path))
+        for _, filename, path in sorted(files):
+            key = os.path.splitext(filename)[0]
+            size = os.path.getsize(path)
+            self.entries[key] = (path, size)
+            self.total_bytes += size
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None or not os.path.exists(entry[0]):
+            if entry is not None:
+                self.entries.pop(key)
+                self.total_bytes -= entry[1]
+            return None
+        self.entries.move_to_end(key)
+        os.utime(entry[0])
+        return entry[0]
+
+    def get(self, key, fetch):
+        """Returns the cached path for key, calling fetch() to download it on a miss."""
+        while True:
+            with self.lock:
+                path = self.lookup(key)
+                if path is not None:
+                    self.hits += 1
+                    return path
+                event = self.loading.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = threading.Event()
+                    self.loading[key] = event
+                    break
+            event.wait()
+
+        try:
+            downloaded = fetch()
+            if not downloaded:
+                return None
+            path = os.path.join(self.folder, f"{key}{os.path.splitext(downloaded)[1]}")
+            os.replace(downloaded, path)
+            with self.lock:
+                size = os.path.getsize(path)
+                self.entries[key] = (path, size)
+                self.total_bytes += size
+                self.evict_locked()
+            return path
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def checkout(self, key, fetch, work_folder='temp'):
+        """Returns a fresh working copy of the cached file in work_folder."""
+        for attempt in range(2):
+            path = self.get(key, fetch)
+            if path is None:
+                return None
+            work_path = os.path.join(work_folder, f"{uuid.uuid4()}{os.path.splitext(path)[1]}")
+            try:
+                shutil.copyfile(path, work_path)
+                return os.path.abspath(work_path)
+            except FileNotFoundError:
+                continue
+        return None
+
+    def evict_locked(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, (path, size) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.error(f"Error removing cached media {path}: {e}")
+
+    def evict(self):
+        with self.lock:
+            self.evict_locked()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+            }
@@ -0,0 +1,215 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+def format_labels(label_names, values, extra=()):
+    pairs = list(zip(label_names, values)) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join(f'{name}="{str(value)}"'.replace('\n', ' ') for name, value in pairs)
+    return '{' + body + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.label_names, key), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Set directly, or pass a function that is read at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), function=None):
+        super().__init__(name, help_text, label_names)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        try:
+            value = self.function()
+        except Exception as e:
+            logging.error(f"Error reading gauge {self.name}: {e}")
+            return []
+        return [(self.name, '', value)]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (bucket_counts, count, total) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.label_names, key, [('le', bound)])
+                    samples.append((f"{self.name}_bucket", labels, cumulative))
+                samples.append((f"{self.name}_bucket", format_labels(self.label_names, key, [('le', '+Inf')]), count))
+                samples.append((f"{self.name}_count", format_labels(self.label_names, key), count))
+                samples.append((f"{self.name}_sum", format_labels(self.label_names, key), round(total, 6)))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=(), function=None):
+        return self.register(Gauge(name, help_text, label_names, function))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram('reddit_poster_stage_seconds', 'Time spent in each pipeline stage', ['stage'])
+STAGE_TOTAL = REGISTRY.counter('reddit_poster_stage_total', 'Pipeline stages run, by result', ['stage', 'result'])
+POSTS_TOTAL = REGISTRY.counter('reddit_poster_posts_total',
+                               'Finished posting jobs, by result and last stage', ['result', 'stage'])
+POST_STEP_SECONDS = REGISTRY.histogram('reddit_poster_post_step_seconds',
+                                       'Time spent in each step of a posting job', ['step'])
+
+
+class StageResult:
+    def __init__(self):
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Records the block's duration under stage. An exception counts as a
+    failure, as does calling fail() on the yielded StageResult, for code
+    that reports errors by return value instead of raising.
+    """
+    started = time.perf_counter()
+    result = StageResult()
+    try:
+        yield result
+    except BaseException:
+        result.fail()
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+        STAGE_TOTAL.inc(stage=stage, result='failure' if result.failed else 'success')
+
+
+def timed(stage, falsy_is_failure=False):
+    """Decorator form of stage_timer; with falsy_is_failure a None/False return counts as a failure."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage) as result:
+                value = fn(*args, **kwargs)
+                if falsy_is_failure and not value:
+                    result.fail()
+                return value
+        return wrapper
+    return decorator
+
+
+def make_handler(registry):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_metrics_server(port, host='127.0.0.1', registry=REGISTRY):
+    """Serves registry in Prometheus text format from a daemon thread. Returns None if port is 0."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), make_handler(registry))
+    except OSError as e:
+        logging.error(f"Metrics server could not bind {host}:{port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Metrics on http://{host}:{server.server_port}/metrics")
+    return server